@@ -0,0 +1,113 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from metrics import record_cache
+
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '5000'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', str(6 * 60 * 60)))
+# Reuse the answer of a different wording when the question embeddings are this similar, 0 disables it
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0.95'))
+
+def normalize_question(question):
+    question = question.lower()
+    question = re.sub(r'[^\w\s\u0600-\u06FF]+', ' ', question)
+    # Drop Arabic diacritics and tatweel so they don't change the key
+    question = re.sub(r'[\u064B-\u0652\u0640]', '', question)
+    return " ".join(question.split())
+
+class AnswerCache:
+    """Answers to previous questions, per document.
+
+    Exact lookups use the normalized question text. When an embedding is
+    given, a question worded differently can reuse an answer whose question
+    embedding has a cosine similarity of at least similarity_threshold.
+    Entries expire after ttl seconds and the least recently used ones are
+    dropped beyond max_entries.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, similarity_threshold=ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()
+        self.document_entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _normalize_vector(self, embedding):
+        vector = np.asarray(embedding, dtype='float32').reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        keys = self.document_entries.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.document_entries[key[0]]
+
+    def get(self, document_key, question, embedding=None):
+        if document_key is None:
+            return None
+        now = time.monotonic()
+        key = (document_key, normalize_question(question))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                record_cache('answers', True)
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+
+            if embedding is not None and self.similarity_threshold > 0:
+                vector = self._normalize_vector(embedding)
+                best_key, best_similarity = None, self.similarity_threshold
+                for other_key in list(self.document_entries.get(document_key, ())):
+                    answer, other_vector, expires = self.entries[other_key]
+                    if expires <= now:
+                        self._remove(other_key)
+                        continue
+                    if other_vector is None:
+                        continue
+                    similarity = float(np.dot(vector, other_vector))
+                    if similarity >= best_similarity:
+                        best_key, best_similarity = other_key, similarity
+                if best_key is not None:
+                    self.entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    record_cache('answers', True)
+                    return self.entries[best_key][0]
+
+            self.misses += 1
+            record_cache('answers', False)
+            return None
+
+    def put(self, document_key, question, answer, embedding=None):
+        if document_key is None:
+            return
+        key = (document_key, normalize_question(question))
+        vector = self._normalize_vector(embedding) if embedding is not None else None
+        with self.lock:
+            self.entries[key] = (answer, vector, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            self.document_entries.setdefault(document_key, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+            }
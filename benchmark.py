@@ -0,0 +1,467 @@
+"""Benchmarks of the ingestion, retrieval and generation pipeline.
+
+Runs offline: Gemini, Google Vision, Telegram and the embedding model are
+replaced by local stand-ins with configurable latency, and the documents are
+synthetic Arabic and English corpora. Results are written as JSON so two
+runs can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json
+    python benchmark.py --compare before.json after.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from types import SimpleNamespace
+import numpy as np
+
+ENGLISH_WORDS = [
+    'cell', 'energy', 'force', 'mass', 'acceleration', 'photosynthesis', 'chloroplast', 'glucose',
+    'equation', 'derivative', 'integral', 'function', 'velocity', 'pressure', 'temperature', 'volume',
+    'revolution', 'empire', 'trade', 'treaty', 'population', 'economy', 'market', 'capital',
+    'molecule', 'atom', 'electron', 'proton', 'reaction', 'acid', 'base', 'solution',
+    'the', 'of', 'and', 'is', 'in', 'to', 'a', 'which', 'that', 'by', 'with', 'from',
+]
+ARABIC_WORDS = [
+    'الخلية', 'الطاقة', 'القوة', 'الكتلة', 'التسارع', 'التمثيل', 'الضوئي', 'الجلوكوز',
+    'المعادلة', 'المشتقة', 'التكامل', 'الدالة', 'السرعة', 'الضغط', 'الحرارة', 'الحجم',
+    'الثورة', 'الإمبراطورية', 'التجارة', 'المعاهدة', 'السكان', 'الاقتصاد', 'السوق', 'رأس',
+    'الجزيء', 'الذرة', 'الإلكترون', 'البروتون', 'التفاعل', 'الحمض', 'القاعدة', 'المحلول',
+    'في', 'من', 'إلى', 'على', 'هو', 'هي', 'التي', 'الذي', 'مع', 'عن', 'أن', 'كان',
+]
+FORMULAS = ['H2O', 'CO2', 'NaCl', 'F=ma', 'E=mc2', 'C6H12O6', 'sin(x)', 'PV=nRT']
+
+def make_corpus(n_words, language='en', seed=0):
+    """Synthetic document of about n_words words, with numbers and formula names like exam material."""
+    rng = random.Random(seed)
+    paragraphs = []
+    words_written = 0
+    while words_written < n_words:
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            words = ARABIC_WORDS if language == 'ar' or (language == 'mixed' and rng.random() < 0.5) else ENGLISH_WORDS
+            sentence = [rng.choice(words) for _ in range(rng.randint(8, 25))]
+            if rng.random() < 0.3:
+                sentence.insert(rng.randrange(len(sentence)), str(rng.randint(1, 2000)))
+            if rng.random() < 0.2:
+                sentence.insert(rng.randrange(len(sentence)), rng.choice(FORMULAS))
+            end = '؟' if words is ARABIC_WORDS and rng.random() < 0.1 else '.'
+            sentences.append(" ".join(sentence) + end)
+            words_written += len(sentence)
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+def make_questions(n, language='en', seed=0):
+    rng = random.Random(seed)
+    words = ARABIC_WORDS if language == 'ar' else ENGLISH_WORDS
+    return [f"{' '.join(rng.choice(words) for _ in range(rng.randint(3, 8)))} {rng.choice(FORMULAS)}?" for _ in range(n)]
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if values else None
+
+def latency_summary(seconds):
+    milliseconds = [s * 1000 for s in seconds]
+    return {'count': len(milliseconds), 'p50_ms': percentile(milliseconds, 50),
+            'p99_ms': percentile(milliseconds, 99), 'mean_ms': float(np.mean(milliseconds)) if milliseconds else None}
+
+def rss_bytes():
+    """Resident memory of this process, from /proc on Linux."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+class FakeEmbedder:
+    """Hashed bag of words vectors, cheap and deterministic, with an optional delay per text."""
+
+    def __init__(self, dimension=384, latency_per_text=0.0):
+        self.dimension = dimension
+        self.latency_per_text = latency_per_text
+
+    def encode(self, texts):
+        from lexical_index import tokenize
+        if self.latency_per_text:
+            time.sleep(self.latency_per_text * len(texts))
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            for token in tokenize(text):
+                vectors[row, zlib.crc32(token.encode('utf-8')) % self.dimension] += 1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+class FakeGeminiModel:
+    """Answers like gemini-pro would for each kind of prompt, after a delay.
+
+    latency is the time to the first token and tokens_per_second the
+    generation speed, streamed responses arrive in pieces at that speed.
+    """
+
+    def __init__(self, latency=0.5, tokens_per_second=200, answer_words=150):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_words = answer_words
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _response_text(self, prompt):
+        rng = random.Random(zlib.crc32(prompt.encode('utf-8')))
+        if prompt.startswith('Generate questions'):
+            return "\n".join(f"- {' '.join(rng.choice(ENGLISH_WORDS) for _ in range(8))} {i}?" for i in range(10))
+        if 'Return only a JSON array of' in prompt:
+            n = int(prompt.split('Return only a JSON array of')[1].split()[0])
+            return json.dumps([" ".join(rng.choice(ENGLISH_WORDS) for _ in range(20)) for _ in range(n)])
+        return " ".join(rng.choice(ENGLISH_WORDS) for _ in range(self.answer_words))
+
+    def generate_content(self, prompt, safety_settings=None, stream=False):
+        with self.lock:
+            self.calls += 1
+        text = self._response_text(prompt)
+        pieces = [text[i:i+200] for i in range(0, len(text), 200)]
+        piece_delay = 50 / self.tokens_per_second  # about 50 tokens per piece
+
+        def stream_pieces():
+            time.sleep(self.latency)
+            for piece in pieces:
+                time.sleep(piece_delay)
+                yield SimpleNamespace(text=piece)
+
+        if stream:
+            return stream_pieces()
+        time.sleep(self.latency + piece_delay * len(pieces))
+        return SimpleNamespace(text=text)
+
+class FakeVision:
+    """Stand-in for google_vision.detect_text_images: encodes the pages like the real call, then waits."""
+
+    def __init__(self, latency=0.3):
+        self.latency = latency
+        self.requests = 0
+
+    def detect_text_images(self, client, images):
+        for image in images:
+            image.save(io.BytesIO(), format='PNG')
+        time.sleep(self.latency)
+        self.requests += 1
+        return [f"page text {i}" for i in range(len(images))]
+
+class FakeTelegram:
+    """Records the calls made by the outbox, each taking latency seconds."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.next_message_id = 1
+        self.last_call = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _record(self, chat_id):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            self.last_call[chat_id] = time.perf_counter()
+            self.next_message_id += 1
+            return self.next_message_id
+
+    def send_message(self, chat_id, text, **kwargs):
+        return SimpleNamespace(message_id=self._record(chat_id), chat=SimpleNamespace(id=chat_id), text=text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self._record(chat_id)
+        return True
+
+def wait_until_sent(outbox):
+    with outbox.condition:
+        while outbox.pending or outbox.busy_chats:
+            outbox.condition.wait(0.01)
+
+def bench_chunking(sizes, languages):
+    from vector_db import chunk_document
+    results = []
+    for language in languages:
+        for n_words in sizes:
+            text = make_corpus(n_words, language, seed=n_words)
+            start = time.perf_counter()
+            parents, children, _ = chunk_document(text)
+            seconds = time.perf_counter() - start
+            results.append({'language': language, 'words': n_words, 'seconds': seconds,
+                             'words_per_second': n_words / seconds, 'parents': len(parents), 'children': len(children)})
+    return results
+
+def bench_parsing(work_dir, n_words):
+    from document_processor import process_document
+    text = make_corpus(n_words, 'mixed', seed=1)
+    lines = text.split('. ')
+    paths = {'txt': os.path.join(work_dir, 'corpus.txt'), 'csv': os.path.join(work_dir, 'corpus.csv'),
+             'xlsx': os.path.join(work_dir, 'corpus.xlsx')}
+    with open(paths['txt'], 'w', encoding='utf-8') as f:
+        f.write(text)
+    import pandas as pd
+    frame = pd.DataFrame({'row': range(len(lines)), 'text': lines})
+    frame.to_csv(paths['csv'], index=False)
+    frame.to_excel(paths['xlsx'], index=False)
+
+    results = []
+    for file_format, path in paths.items():
+        start = time.perf_counter()
+        process_document(path, False)
+        seconds = time.perf_counter() - start
+        megabytes = os.path.getsize(path) / 1e6
+        results.append({'format': file_format, 'megabytes': megabytes, 'seconds': seconds,
+                        'megabytes_per_second': megabytes / seconds})
+    return results
+
+def bench_ingestion(sizes, languages, first_user_id):
+    import vector_db
+    results = []
+    user_id = first_user_id
+    for language in languages:
+        for n_words in sizes:
+            text = make_corpus(n_words, language, seed=user_id)
+            start = time.perf_counter()
+            vector_db.add_document_to_db(text, 'txt', user_id, f'{language}-{n_words}')
+            seconds = time.perf_counter() - start
+            results.append({'language': language, 'words': n_words, 'seconds': seconds, 'words_per_second': n_words / seconds})
+            user_id += 1
+    return results
+
+def bench_search(n_queries, n_words, n_documents, user_id):
+    import vector_db
+    for i in range(n_documents):
+        vector_db.add_document_to_db(make_corpus(n_words, 'mixed', seed=user_id * 100 + i), 'txt', user_id, f'chapter {i + 1}')
+    questions = make_questions(n_queries // 2, 'en', seed=1) + make_questions(n_queries - n_queries // 2, 'ar', seed=2)
+
+    encode_times, search_times, document_times = [], [], []
+    for question in questions:
+        start = time.perf_counter()
+        query_vector = vector_db.encode_query(question)
+        encoded = time.perf_counter()
+        vector_db.get_relevant_chunks(question, user_id, query_vector=query_vector)
+        searched = time.perf_counter()
+        vector_db.get_relevant_chunks(question, user_id, query_vector=query_vector, document_ids=[1])
+        document_times.append(time.perf_counter() - searched)
+        encode_times.append(encoded - start)
+        search_times.append(searched - encoded)
+    return {'documents': n_documents, 'words_per_document': n_words, 'hybrid': vector_db.HYBRID_SEARCH,
+            'encode': latency_summary(encode_times), 'corpus_search': latency_summary(search_times),
+            'document_search': latency_summary(document_times)}
+
+def bench_memory(n_users, n_words, first_user_id):
+    import vector_db
+    db = vector_db.vector_db
+    rss_before = rss_bytes()
+    hot_before = db.hot_bytes
+    disk_before = directory_bytes(db.storage_dir)
+    for user_id in range(first_user_id, first_user_id + n_users):
+        vector_db.add_document_to_db(make_corpus(n_words, 'mixed', seed=user_id), 'txt', user_id)
+        vector_db.get_relevant_chunks('energy', user_id)
+    rss_after = rss_bytes()
+    return {'users': n_users, 'words_per_user': n_words,
+            'index_bytes_per_user': (db.hot_bytes - hot_before) / n_users,
+            'rss_bytes_per_user': (rss_after - rss_before) / n_users if rss_before is not None else None,
+            'disk_bytes_per_user': (directory_bytes(db.storage_dir) - disk_before) / n_users}
+
+def bench_ocr(work_dir, n_pages, vision_latency):
+    from PyPDF2 import PdfWriter
+    import google_vision
+    path = os.path.join(work_dir, 'scanned.pdf')
+    writer = PdfWriter()
+    for _ in range(n_pages):
+        writer.add_blank_page(width=595, height=842)
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+    vision = FakeVision(vision_latency)
+    real_detect = google_vision.detect_text_images
+    google_vision.detect_text_images = vision.detect_text_images
+    try:
+        start = time.perf_counter()
+        google_vision.detect_text_pdf(path, True, client=object())
+        seconds = time.perf_counter() - start
+    finally:
+        google_vision.detect_text_images = real_detect
+    return {'pages': n_pages, 'vision_latency': vision_latency, 'requests': vision.requests,
+            'seconds': seconds, 'pages_per_second': n_pages / seconds}
+
+def bench_generation(n_words, user_id, gemini):
+    import vector_db
+    from gemini_handler import generate_qa_for_chunks
+    from summarizer import summarize_document
+    vector_db.add_document_to_db(make_corpus(n_words, 'en', seed=user_id), 'txt', user_id)
+
+    calls = gemini.calls
+    start = time.perf_counter()
+    generate_qa_for_chunks(vector_db.get_chunks(user_id), 'medium', 10)
+    qa_seconds = time.perf_counter() - start
+    qa_calls = gemini.calls - calls
+
+    sections = vector_db.get_sections(user_id)
+    timings = []
+    for _ in range(2):
+        calls = gemini.calls
+        start = time.perf_counter()
+        for _ in summarize_document(sections):
+            pass
+        timings.append((time.perf_counter() - start, gemini.calls - calls))
+    return {'words': n_words, 'qa_seconds': qa_seconds, 'qa_calls': qa_calls,
+            'summary_cold_seconds': timings[0][0], 'summary_cold_calls': timings[0][1],
+            'summary_cached_seconds': timings[1][0], 'summary_cached_calls': timings[1][1]}
+
+def bench_end_to_end(n_questions, n_words, user_id, telegram):
+    """Time from a question reaching handle_question to the last message edit of the answer."""
+    import main
+    import vector_db
+    main.outbox.bot = telegram
+    vector_db.add_document_to_db(make_corpus(n_words, 'mixed', seed=user_id), 'txt', user_id)
+    questions = make_questions(n_questions, 'en', seed=3)
+
+    def ask(question, message_id):
+        message = SimpleNamespace(chat=SimpleNamespace(id=user_id), from_user=SimpleNamespace(id=user_id),
+                                  text=question, message_id=message_id)
+        start = time.perf_counter()
+        main.handle_question(message)
+        wait_until_sent(main.outbox)
+        return telegram.last_call[user_id] - start
+
+    # The second round is served from the answer cache
+    fresh = [ask(question, i) for i, question in enumerate(questions)]
+    cached = [ask(question, i) for i, question in enumerate(questions)]
+    return {'words': n_words, 'telegram_latency': telegram.latency,
+            'fresh': latency_summary(fresh), 'cached': latency_summary(cached)}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def flatten(results, prefix=''):
+    """Numeric values of nested results keyed by their path, e.g. 'search.corpus_search.p50_ms'."""
+    values = {}
+    if isinstance(results, dict):
+        items = results.items()
+    elif isinstance(results, list):
+        # Lists of runs are keyed by what identifies each run
+        items = ((".".join(str(v) for k, v in item.items() if isinstance(v, str) or k in ('words', 'format')) or str(i), item)
+                 for i, item in enumerate(results))
+    else:
+        return {prefix: results} if isinstance(results, (int, float)) and not isinstance(results, bool) else {}
+    for key, value in items:
+        values.update(flatten(value, f"{prefix}.{key}" if prefix else str(key)))
+    return values
+
+def compare(before_path, after_path, threshold=0.1):
+    """Print the metrics that changed by more than threshold between two result files."""
+    with open(before_path) as f:
+        before = flatten({k: v for k, v in json.load(f).items() if k != 'meta'})
+    with open(after_path) as f:
+        after = flatten({k: v for k, v in json.load(f).items() if k != 'meta'})
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        if old and new is not None and abs(new - old) / abs(old) > threshold:
+            print(f"{key}: {old:.4g} -> {new:.4g} ({(new - old) / abs(old):+.0%})")
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    # Everything the bot stores goes to a temporary directory, before the modules read their settings
+    os.environ.update({
+        'VECTOR_DB_DIR': os.path.join(work_dir, 'vector_store'),
+        'EXTRACTION_CACHE_DIR': os.path.join(work_dir, 'extraction_cache'),
+        'STATE_BACKEND': 'memory',
+        'TELEGRAM_BOT_TOKEN': '0:benchmark',
+        # Measure the bot, not Telegram's per-chat limit
+        'OUTBOX_CHAT_RATE': '1000',
+        'OUTBOX_CHAT_BURST': '1000',
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import vector_db
+    import gemini_handler
+    if args.embedder == 'fake':
+        vector_db.vector_db._model = FakeEmbedder(latency_per_text=args.embedding_latency)
+    else:
+        from embedding_backends import create_embedder
+        vector_db.vector_db._model = create_embedder(vector_db.MODEL_NAME, args.embedder)
+    gemini = FakeGeminiModel(args.gemini_latency, args.gemini_tokens_per_second)
+    gemini_handler.model = gemini
+    telegram = FakeTelegram(args.telegram_latency)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    languages = ['en', 'ar', 'mixed']
+    results = {'meta': {
+        'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+        'platform': platform.platform(), 'cpus': os.cpu_count(), 'arguments': vars(args),
+    }}
+    steps = [
+        ('chunking', lambda: bench_chunking(sizes, languages)),
+        ('parsing', lambda: bench_parsing(work_dir, max(sizes))),
+        ('ingestion', lambda: bench_ingestion(sizes, languages, first_user_id=1000)),
+        ('search', lambda: bench_search(args.queries, min(sizes), args.documents, user_id=2000)),
+        ('memory', lambda: bench_memory(args.users, min(sizes), first_user_id=3000)),
+        ('ocr', lambda: bench_ocr(work_dir, args.pages, args.vision_latency)),
+        ('generation', lambda: bench_generation(max(sizes), 4000, gemini)),
+        ('end_to_end', lambda: bench_end_to_end(args.questions, min(sizes), 5000, telegram)),
+    ]
+    try:
+        for name, step in steps:
+            if args.only and name not in args.only.split(','):
+                continue
+            print(f"Running {name}...", file=sys.stderr)
+            try:
+                results[name] = step()
+            except Exception as e:
+                # A missing optional library shouldn't hide the other results
+                results[name] = {'error': f"{type(e).__name__}: {e}"}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='5000,50000,200000', help='corpus sizes in words')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--documents', type=int, default=5, help='documents in the corpus searched by the search benchmark')
+    parser.add_argument('--users', type=int, default=20, help='users for the memory benchmark')
+    parser.add_argument('--pages', type=int, default=40, help='pages of the OCR benchmark')
+    parser.add_argument('--questions', type=int, default=20, help='questions of the end to end benchmark')
+    parser.add_argument('--embedder', default='fake', help="'fake' or an EMBEDDING_BACKEND to use the real model")
+    parser.add_argument('--embedding-latency', type=float, default=0.0, help='seconds per text added by the fake embedder')
+    parser.add_argument('--gemini-latency', type=float, default=0.5, help='seconds to the first token')
+    parser.add_argument('--gemini-tokens-per-second', type=float, default=200)
+    parser.add_argument('--vision-latency', type=float, default=0.3, help='seconds per Vision request')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='seconds per Telegram API call')
+    parser.add_argument('--only', help='comma separated benchmarks to run, e.g. search,memory')
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = json.dumps(run(args), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(results)
+    else:
+        print(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+import pickle
+import threading
+from metrics import record_cache
+
+class DiskCache:
+    """Size-bounded cache storing one pickled value per file.
+
+    Reading an entry refreshes its modification time, and once the total
+    size exceeds max_bytes the least recently used files are deleted.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        # Hits and misses are counted under the directory name
+        self.name = os.path.basename(os.path.normpath(directory))
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            record_cache(self.name, False)
+            return None
+        except (pickle.UnpicklingError, EOFError):
+            # A broken entry is treated as a miss and removed
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            record_cache(self.name, False)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another thread since it was read, the value is still good
+            pass
+        record_cache(self.name, True)
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith('.pkl'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
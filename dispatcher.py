@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from metrics import STAGE_SECONDS, timed, new_trace
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_chat_id(update):
+    """Return the chat an update belongs to, used to keep per-chat ordering."""
+    if update.message is not None:
+        return update.message.chat.id
+    if update.edited_message is not None:
+        return update.edited_message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """Runs update handlers on a fixed pool of worker threads.
+
+    Updates wait in one queue per chat. A free worker takes the next update
+    of the first chat that no other worker is handling, so updates from the
+    same chat are handled in the order they arrived, and a long handler only
+    holds up its own chat. When num_workers * queue_size updates are
+    waiting, submit() blocks, which slows down polling instead of letting
+    the backlog grow without limit.
+    """
+
+    def __init__(self, handler, num_workers=8, queue_size=100):
+        self.handler = handler
+        self.num_workers = num_workers
+        self.max_pending = num_workers * queue_size
+        # chat_id -> deque of (update, time submitted), chats in the order they got work
+        self.pending = OrderedDict()
+        self.pending_count = 0
+        self.busy_chats = set()
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        # Webhook request threads may call this at the same time
+        with self.condition:
+            if self.threads:
+                return
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._worker, name=f"update-worker-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        logger.info(f"Update dispatcher started with {self.num_workers} workers")
+
+    def submit(self, update):
+        chat_id = get_update_chat_id(update)
+        with self.condition:
+            if self.pending_count >= self.max_pending:
+                logger.warning(f"{self.pending_count} updates are waiting, polling waits for a free slot")
+                while self.pending_count >= self.max_pending:
+                    self.condition.wait()
+            self.pending.setdefault(chat_id, deque()).append((update, time.perf_counter()))
+            self.pending_count += 1
+            self.condition.notify_all()
+
+    def _next_chat(self):
+        """First chat with waiting updates that no worker is handling, or None."""
+        for chat_id in self.pending:
+            if chat_id not in self.busy_chats:
+                return chat_id
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                chat_id = self._next_chat()
+                while chat_id is None:
+                    self.condition.wait()
+                    chat_id = self._next_chat()
+                chat_queue = self.pending[chat_id]
+                update, submitted = chat_queue.popleft()
+                if not chat_queue:
+                    del self.pending[chat_id]
+                self.pending_count -= 1
+                self.busy_chats.add(chat_id)
+                self.condition.notify_all()
+
+            STAGE_SECONDS.observe(time.perf_counter() - submitted, stage='queue_wait')
+            # Everything done for this update is logged with its trace id
+            new_trace()
+            try:
+                with timed('update'):
+                    self.handler(update)
+            except Exception as e:
+                logger.error(f"Error while handling update {update.update_id}: {e}")
+            finally:
+                with self.condition:
+                    self.busy_chats.discard(chat_id)
+                    self.condition.notify_all()
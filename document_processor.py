@@ -1,61 +1,129 @@
-import PyPDF2
-import pandas as pd
-import openpyxl
-import chardet
+# Parsing libraries are imported inside the functions that need them to keep startup fast
+import logging
 from google_vision import detect_text_pdf, read_text_from_image
-import pandas as pd
-def detect_encoding(file_path):
+
+logger = logging.getLogger(__name__)
+
+# Bytes read to guess the encoding of text files
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# Rows of a spreadsheet or CSV converted to text at once
+ROWS_PER_BATCH = 1000
+# Characters read at once from a text file
+TEXT_BLOCK_SIZE = 1024 * 1024
+
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff', 'tif', 'webp', 'ico', 'heic', 'heif', 'svg', 'raw', 'arw', 'cr2', 'nef', 'orf', 'sr2']
+
+def detect_encoding(file_path, sample_size=ENCODING_SAMPLE_SIZE):
+    import chardet
     with open(file_path, 'rb') as file:
-        raw_data = file.read()
-    return chardet.detect(raw_data)['encoding']
+        raw_data = file.read(sample_size)
+    encoding = chardet.detect(raw_data)['encoding']
+    # An ASCII sample says nothing about the rest of the file, UTF-8 reads ASCII and any Arabic after it
+    if encoding is None or encoding.lower() == 'ascii':
+        return 'utf-8'
+    return encoding
+
+def process_document(file_path,watermark,progress=None):
+    return "".join(iter_document(file_path, watermark, progress))
 
-def process_document(file_path,watermark):
+def iter_document(file_path, watermark, progress=None):
+    """Yield the text of a document piece by piece (pages, row batches or blocks).
+
+    progress(pages_done, total_pages) is called while a watermarked PDF is OCR'd.
+    """
     file_extension = file_path.split('.')[-1].lower()
     
     if file_extension == 'pdf':
-        return detect_text_pdf(file_path,watermark)
-    elif file_extension in ['xlsx', 'xls']:
-        return process_excel(file_path)
+        if watermark:
+            yield detect_text_pdf(file_path, watermark, progress)
+        else:
+            yield from iter_pdf(file_path)
+    elif file_extension == 'xlsx':
+        yield from iter_excel(file_path)
+    elif file_extension == 'xls':
+        # openpyxl can't read the old format, fall back to pandas
+        import pandas as pd
+        yield from iter_dataframes([pd.read_excel(file_path)])
     elif file_extension == 'csv':
-        return process_csv(file_path)
+        yield from iter_csv(file_path)
     elif file_extension == 'txt':
-        return process_txt(file_path)
+        yield from iter_txt(file_path)
     elif file_extension== 'docx':
-        return process_docx(file_path)
-    elif file_extension in ['jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff', 'tif', 'webp', 'ico', 'heic', 'heif', 'svg', 'raw', 'arw', 'cr2', 'nef', 'orf', 'sr2']:
+        yield from iter_docx(file_path)
+    elif file_extension in IMAGE_EXTENSIONS:
         result = read_text_from_image(file_path)
-        print(result)
-        return result
+        logger.debug(f"Read {len(result)} characters from image {file_path}")
+        yield result
     else:
         raise ValueError(f"Unsupported file format: {file_extension}")
     
-def process_pdf(file_path):
+def iter_pdf(file_path):
+    import PyPDF2
     with open(file_path, 'rb') as file:
         reader = PyPDF2.PdfReader(file)
-        text = ""
         for page in reader.pages:
-            text += page.extract_text() + "\n"
-    return text
+            yield page.extract_text() + "\n"
+
+def process_pdf(file_path):
+    return "".join(iter_pdf(file_path))
+
+def iter_rows(rows):
+    """Turn rows of cell values into text, ROWS_PER_BATCH rows at a time."""
+    lines = []
+    for row in rows:
+        lines.append(" ".join("" if value is None else str(value) for value in row))
+        if len(lines) == ROWS_PER_BATCH:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+def iter_excel(file_path):
+    import openpyxl
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield from iter_rows(sheet.iter_rows(values_only=True))
+    finally:
+        workbook.close()
 
 def process_excel(file_path):
-    df = pd.read_excel(file_path)
-    return df.to_string()
+    return "".join(iter_excel(file_path))
+
+def iter_dataframes(frames):
+    for n, df in enumerate(frames):
+        yield df.to_string(header=(n == 0)) + "\n"
+
+def iter_docx(file_path):
+    import openpyxl
+    doc = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        for sheet in doc.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                yield "".join(str(value) + " " for value in row)
+    finally:
+        doc.close()
 
 def process_docx(file_path):
-    doc = openpyxl.load_workbook(file_path)
-    text = ""
-    for sheet in doc.worksheets:
-        for row in sheet.rows:
-            for cell in row:
-                text += str(cell.value) + " "
-    return text
+    return "".join(iter_docx(file_path))
+
+def iter_csv(file_path):
+    import pandas as pd
+    encoding = detect_encoding(file_path)
+    # Bytes the sampled encoding can't decode are replaced instead of failing the whole file
+    yield from iter_dataframes(pd.read_csv(file_path, encoding=encoding, encoding_errors='replace', chunksize=ROWS_PER_BATCH))
     
 def process_csv(file_path):
-    encoding = detect_encoding(file_path)
-    df = pd.read_csv(file_path, encoding=encoding)
-    return df.to_string()
+    return "".join(iter_csv(file_path))
 
-def process_txt(file_path):
+def iter_txt(file_path):
     encoding = detect_encoding(file_path)
     with open(file_path, 'r', encoding=encoding, errors='replace') as file:
-        return file.read()
\ No newline at end of file
+        while True:
+            block = file.read(TEXT_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+
+def process_txt(file_path):
+    return "".join(iter_txt(file_path))
@@ -0,0 +1,136 @@
+import os
+import sys
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+# 'torch' (reference SentenceTransformer), 'onnx' or 'onnx-int8' (ONNX Runtime, int8 quantized weights)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', '0'))  # 0 keeps the library default
+EMBEDDING_ONNX_DIR = os.getenv('EMBEDDING_ONNX_DIR', 'onnx_model')
+# The model was trained with inputs of at most 128 tokens
+MAX_SEQUENCE_LENGTH = 128
+
+# Fixed texts used to compare a backend with the reference one
+EQUIVALENCE_CORPUS = [
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "The derivative of sin(x) is cos(x).",
+    "Newton's second law states that force equals mass times acceleration.",
+    "Which organelle is known as the powerhouse of the cell?",
+    "The French Revolution began in 1789.",
+    "التمثيل الضوئي يحول الطاقة الضوئية إلى طاقة كيميائية.",
+    "ما هي عاصمة جمهورية مصر العربية؟",
+    "القانون الثاني لنيوتن ينص على أن القوة تساوي الكتلة في التسارع.",
+    "يتكون الماء من ذرتي هيدروجين وذرة أكسجين.",
+    "Chapter 3 exam: answer all questions in the space provided.",
+]
+
+class TorchEmbedder:
+    def __init__(self, model_name, threads=EMBEDDING_THREADS):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts):
+        return self.model.encode(texts)
+
+class OnnxEmbedder:
+    """Runs the same model with ONNX Runtime, using mean pooling like SentenceTransformer."""
+
+    def __init__(self, model_name, model_dir=EMBEDDING_ONNX_DIR, quantized=False, threads=EMBEDDING_THREADS, batch_size=32):
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError(f"The ONNX backends need onnxruntime and transformers, install them with "
+                              f"'pip install onnxruntime transformers': {e}") from e
+        model_path = export_onnx_model(model_name, model_dir, quantized)
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+
+    def encode(self, texts):
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            tokens = self.tokenizer(texts[i:i+self.batch_size], padding=True, truncation=True,
+                                    max_length=MAX_SEQUENCE_LENGTH, return_tensors='np')
+            inputs = {name: tokens[name].astype('int64') for name in self.input_names}
+            token_embeddings = self.session.run(None, inputs)[0]
+            mask = tokens['attention_mask'][..., None].astype('float32')
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            embeddings.append(pooled.astype('float32'))
+        return np.vstack(embeddings)
+
+def export_onnx_model(model_name, model_dir=EMBEDDING_ONNX_DIR, quantized=False):
+    """Export the model to ONNX in model_dir if needed, returns the path of the model file."""
+    model_path = os.path.join(model_dir, 'model.onnx')
+    if not os.path.exists(model_path):
+        try:
+            import torch
+            from transformers import AutoModel, AutoTokenizer
+        except ImportError as e:
+            raise ImportError(f"Exporting the model to ONNX needs torch and transformers (installed with "
+                              f"sentence-transformers), or an exported model in {model_dir}: {e}") from e
+        print(f'Exporting {model_name} to ONNX...')
+        os.makedirs(model_dir, exist_ok=True)
+        hub_name = f'sentence-transformers/{model_name}'
+        tokenizer = AutoTokenizer.from_pretrained(hub_name)
+        model = AutoModel.from_pretrained(hub_name)
+        model.eval()
+        tokenizer.save_pretrained(model_dir)
+        sample = tokenizer(['export'], return_tensors='pt')
+        torch.onnx.export(
+            model, (sample['input_ids'], sample['attention_mask']), model_path,
+            input_names=['input_ids', 'attention_mask'], output_names=['token_embeddings'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                          'attention_mask': {0: 'batch', 1: 'sequence'},
+                          'token_embeddings': {0: 'batch', 1: 'sequence'}},
+            opset_version=14)
+
+    if not quantized:
+        return model_path
+
+    quantized_path = os.path.join(model_dir, 'model-int8.onnx')
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print('Quantizing the ONNX model to int8...')
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+def create_embedder(model_name, backend=EMBEDDING_BACKEND):
+    if backend == 'torch':
+        return TorchEmbedder(model_name)
+    elif backend == 'onnx':
+        return OnnxEmbedder(model_name)
+    elif backend == 'onnx-int8':
+        return OnnxEmbedder(model_name, quantized=True)
+    raise ValueError(f"Unsupported embedding backend: {backend}")
+
+def check_equivalence(model_name, backend, reference='torch', corpus=EQUIVALENCE_CORPUS, min_similarity=0.98):
+    """Compare the embeddings of a backend with the reference backend on a fixed corpus.
+
+    Returns the lowest cosine similarity between the two embeddings of a text
+    and whether it reaches min_similarity.
+    """
+    expected = np.asarray(create_embedder(model_name, reference).encode(corpus), dtype='float32')
+    actual = np.asarray(create_embedder(model_name, backend).encode(corpus), dtype='float32')
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    actual /= np.linalg.norm(actual, axis=1, keepdims=True)
+    similarities = (expected * actual).sum(axis=1)
+    lowest = float(similarities.min())
+    return lowest, lowest >= min_similarity
+
+if __name__ == '__main__':
+    # Usage: python embedding_backends.py [backend]
+    backend = sys.argv[1] if len(sys.argv) > 1 else EMBEDDING_BACKEND
+    lowest, ok = check_equivalence(MODEL_NAME, backend)
+    print(f"{backend}: lowest cosine similarity with torch is {lowest:.4f} ({'OK' if ok else 'TOO LOW'})")
+    sys.exit(0 if ok else 1)
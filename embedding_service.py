@@ -0,0 +1,106 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingService:
+    """Encodes texts from all users in shared micro-batches.
+
+    Callers submit texts and get a Future. A single worker thread takes the
+    first pending request, waits up to max_wait seconds for more requests to
+    arrive and encodes them together, stopping once max_batch_size texts
+    are collected.
+    Large requests are split into slices that are queued one after the
+    other, so a short query from another user waits for at most one slice
+    instead of a whole document.
+    """
+
+    def __init__(self, encode, max_batch_size=64, max_wait=0.01):
+        self.encode_batch = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, name='embedding-service', daemon=True)
+                self.thread.start()
+
+    def submit(self, texts):
+        """Queue texts for encoding, the Future resolves to one embedding row per text."""
+        self.start()
+        texts = list(texts)
+        if len(texts) <= self.max_batch_size:
+            future = Future()
+            self.requests.put((texts, future))
+            return future
+
+        slices = [texts[i:i+self.max_batch_size] for i in range(0, len(texts), self.max_batch_size)]
+        future = Future()
+        self._queue_slice(slices, [], future)
+        return future
+
+    def encode(self, texts):
+        return self.submit(texts).result()
+
+    def _queue_slice(self, slices, results, future):
+        """Queue the next slice once the previous one is encoded, so requests that
+        arrived in the meantime are encoded before it."""
+        slice_future = Future()
+
+        def on_done(done):
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+                return
+            results.append(done.result())
+            if len(results) == len(slices):
+                future.set_result(np.vstack(results))
+            else:
+                self._queue_slice(slices, results, future)
+
+        slice_future.add_done_callback(on_done)
+        self.requests.put((slices[len(results)], slice_future))
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            try:
+                embeddings = self.encode_batch(texts) if texts else None
+            except Exception as e:
+                logger.error(f"Embedding batch of {len(texts)} texts failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for request_texts, future in batch:
+                end = start + len(request_texts)
+                if embeddings is None:
+                    future.set_result(np.zeros((0, 0), dtype='float32'))
+                else:
+                    future.set_result(embeddings[start:end])
+                start = end
@@ -1,14 +1,34 @@
 import os
+import json
+import re
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import google.generativeai as genai
-from google.generativeai import GenerativeModel
+from metrics import timed
 import random
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
-genai.configure(api_key=GOOGLE_API_KEY)
-model = GenerativeModel('gemini-pro')
+# The Gemini client is slow to import, it is created on first use
+model = None
+model_lock = threading.Lock()
+
+# Concurrency settings for Gemini calls
+GEMINI_MAX_WORKERS = int(os.getenv('GEMINI_MAX_WORKERS', '16'))  # calls in flight across all users
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '5'))  # calls in flight for one request
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '120'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '3'))
+GEMINI_BACKOFF_BASE = float(os.getenv('GEMINI_BACKOFF_BASE', '1'))
+
+gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_WORKERS, thread_name_prefix='gemini')
 
 def set_minimal_safety_settings():
     return [
@@ -32,18 +52,131 @@ def set_minimal_safety_settings():
 
 safety_settings = set_minimal_safety_settings()
 
-def answer_question(context, question):
-    prompt = f"Context: {context}\n\nQuestion: {question}\n\n fill any missings @ or .\n Answer:"
-    response = model.generate_content(prompt, safety_settings=safety_settings)
-    return response.text
-
-def Summarize(chunks):
-    summaries = []
-    print('number of chunks:', len(chunks))
-    for chunk in chunks:
-#         prompt = f"""can you summarize extensively and describtivly this text and keep the original language of it 
-#         And be very descriptive with the summarization detailed don't wrap it up, and ensure that no unsafe or sexually explicit content is included in the summary. Maintain the same language as the original text. and tell it like you are telling a story: \n\n{chunk}"""
-        prompt = f"""
+def get_model():
+    global model
+    with model_lock:
+        if model is None:
+            import google.generativeai as genai
+            genai.configure(api_key=GOOGLE_API_KEY)
+            model = genai.GenerativeModel('gemini-pro')
+    return model
+
+def retryable_errors():
+    """429 and 5xx responses are worth retrying."""
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.InternalServerError,
+        google_exceptions.BadGateway,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.GatewayTimeout,
+        google_exceptions.DeadlineExceeded,
+    )
+
+def _backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, GEMINI_BACKOFF_BASE * (2 ** attempt))
+
+def _generate_content(prompt):
+    with timed('gemini'):
+        response = get_model().generate_content(prompt, safety_settings=safety_settings)
+        return response.text
+
+async def _generate_async(prompt, semaphore):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            try:
+                # Run in a copy of this context so the call is logged with the update's trace id
+                call = loop.run_in_executor(gemini_executor, contextvars.copy_context().run, _generate_content, prompt)
+                return await asyncio.wait_for(call, GEMINI_TIMEOUT)
+            except Exception as e:
+                # A timed out call still holds its executor thread, so timeouts are not retried:
+                # a retry would run next to it and a slow backend would fill the shared pool
+                if not isinstance(e, retryable_errors()) or attempt == GEMINI_MAX_RETRIES:
+                    raise
+                delay = _backoff_delay(attempt)
+                logger.warning(f"Gemini call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+async def _generate_all(prompts, return_exceptions):
+    semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+    tasks = [_generate_async(prompt, semaphore) for prompt in prompts]
+    return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+
+def generate_many(prompts, return_exceptions=False):
+    """Send all prompts to Gemini concurrently and return the texts in the same order.
+
+    With return_exceptions=True a failed prompt gives its exception instead of
+    failing the whole batch.
+    """
+    if not prompts:
+        return []
+    return asyncio.run(_generate_all(prompts, return_exceptions))
+
+_STREAM_DONE = object()
+
+def _read_stream(prompt, pieces):
+    try:
+        response = get_model().generate_content(prompt, safety_settings=safety_settings, stream=True)
+        for chunk in response:
+            pieces.put(chunk.text)
+    except Exception as e:
+        pieces.put(e)
+    pieces.put(_STREAM_DONE)
+
+def _stream_content(prompt):
+    """Yield the pieces of a streamed response, read by a separate thread.
+
+    Raises TimeoutError when the first piece or the next one doesn't arrive
+    within GEMINI_TIMEOUT, so a stalled stream can't block the caller forever.
+    """
+    with timed('gemini_stream'):
+        pieces = queue.Queue()
+        reader = threading.Thread(target=contextvars.copy_context().run, args=(_read_stream, prompt, pieces),
+                                  name='gemini-stream', daemon=True)
+        reader.start()
+        while True:
+            try:
+                piece = pieces.get(timeout=GEMINI_TIMEOUT)
+            except queue.Empty:
+                raise TimeoutError(f"No response from Gemini for {GEMINI_TIMEOUT:g}s")
+            if piece is _STREAM_DONE:
+                return
+            if isinstance(piece, Exception):
+                raise piece
+            yield piece
+
+def stream_text(prompt):
+    """Yield the response to a prompt piece by piece as Gemini produces it.
+
+    Retryable errors are only retried before the first piece was received.
+    """
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        started = False
+        try:
+            for piece in _stream_content(prompt):
+                started = True
+                yield piece
+            return
+        except Exception as e:
+            if started or not isinstance(e, retryable_errors()) or attempt == GEMINI_MAX_RETRIES:
+                raise
+            delay = _backoff_delay(attempt)
+            logger.warning(f"Gemini stream failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def build_answer_prompt(context, question):
+    return f"Context: {context}\n\nQuestion: {question}\n\n fill any missings @ or .\n Answer:"
+
+def answer_question_stream(context, question):
+    return stream_text(build_answer_prompt(context, question))
+
+def build_summary_prompt(chunk):
+#     prompt = f"""can you summarize extensively and describtivly this text and keep the original language of it 
+#     And be very descriptive with the summarization detailed don't wrap it up, and ensure that no unsafe or sexually explicit content is included in the summary. Maintain the same language as the original text. and tell it like you are telling a story: \n\n{chunk}"""
+    prompt = f"""
         Please provide a detailed summary of the following text, **strictly adhering to its original language and style**. The summary should be comprehensive, avoiding excessive brevity or generalization. 
 
         **Key points to consider:**
@@ -55,70 +188,117 @@ def Summarize(chunks):
         **Text to summarize:**\n
         {chunk}
         """
-        response = model.generate_content(prompt, safety_settings=safety_settings)
-        print('response.prompt_feedback:', response.prompt_feedback)
-        summaries.append(response.text)
-    print('length of summaries:', len(summaries))
-    return summaries
+    return prompt
 
 def generate_qa_for_chunks(chunks, difficulty, number_of_questions=10, cached_questions=None):
-    all_questions = []
     all_qa_pairs = {}
     
     if cached_questions is None:
         cached_questions = [[] for _ in chunks]
     
-    for i, chunk in enumerate(chunks):
-        # Use cached questions if available, otherwise generate new ones
-        if cached_questions[i]:
-            questions = cached_questions[i]
-        else:
-            # Generate questions
-            prompt_questions = f"""Generate questions based on the text below with the same text language don't generate the answers but make sure that each question has an answer. 
-            Format them as follows:
+    # Generate questions for the chunks that are not cached yet, all at once
+    missing = [i for i, questions in enumerate(cached_questions) if not questions]
+    prompts = []
+    for i in missing:
+        prompt_questions = f"""Generate questions based on the text below with the same text language don't generate the answers but make sure that each question has an answer. 
+        Format them as follows:
 
-            -
-            -
-            -
+        -
+        -
+        -
 
-            Generate {difficulty} questions
-            don't write anything else other than the questions
-            \n{chunk}"""
+        Generate {difficulty} questions
+        don't write anything else other than the questions
+        \n{chunks[i]}"""
+        prompts.append(prompt_questions)
 
-            print(f"Generating questions for chunk {i + 1}/{len(chunks)}...")
-            
-            try:
-                response = model.generate_content(prompt_questions, safety_settings=safety_settings)
-                questions_text = response.text.strip()
-                generated_questions = questions_text.splitlines()
-
-                questions = []
-                for question in generated_questions:
-                    question = question.strip()
-                    if question and question.startswith('-'):
-                        questions.append(question[1:].strip())
-                
-                # Cache the generated questions
-                cached_questions[i] = questions
-            
-            except Exception as e:
-                print(f"An error occurred for chunk {i + 1}: {e}")
-                continue  # Ignore the error and move on to the next chunk
-        
-        all_questions.extend(questions)
+    logger.info(f"Generating questions for {len(missing)}/{len(chunks)} chunks")
+    responses = generate_many(prompts, return_exceptions=True)
+
+    for i, response in zip(missing, responses):
+        if isinstance(response, Exception):
+            logger.error(f"Question generation failed for chunk {i + 1}: {response}")
+            continue  # Ignore the error and move on to the next chunk
+
+        questions = []
+        for question in response.strip().splitlines():
+            question = question.strip()
+            if question and question.startswith('-'):
+                questions.append(question[1:].strip())
+
+        # Cache the generated questions
+        cached_questions[i] = questions
+
+    # Remember which chunk each question came from
+    question_chunks = {}
+    for i, questions in enumerate(cached_questions):
+        for question in questions:
+            question_chunks.setdefault(question, i)
+    all_questions = list(question_chunks)
     
     # Randomly select the required number of questions from all generated questions
     selected_questions = random.sample(all_questions, min(number_of_questions, len(all_questions)))
     
-    # Generate answers for the selected questions
+    # Group the selected questions by their source chunk
+    questions_by_chunk = {}
     for question in selected_questions:
-        # Find the chunk that contains the answer to this question
-        for i, chunk in enumerate(chunks):
-            if question in cached_questions[i]:
-                prompt_answer = f'Answer the following question:\n\n{question}\n\nusing the following text:\n\n{chunk}\n\n'
-                response = model.generate_content(prompt_answer, safety_settings=safety_settings)
-                answer = response.text.strip()
-                all_qa_pairs[question] = answer
-                break
+        questions_by_chunk.setdefault(question_chunks[question], []).append(question)
+
+    # Answer all the questions of a chunk in a single call
+    chunk_ids = list(questions_by_chunk)
+    prompts = [build_batch_answer_prompt(questions_by_chunk[i], chunks[i]) for i in chunk_ids]
+    responses = generate_many(prompts, return_exceptions=True)
+
+    missing_answers = []
+    for i, response in zip(chunk_ids, responses):
+        questions = questions_by_chunk[i]
+        answers = None
+        if isinstance(response, Exception):
+            logger.error(f"Batch answering failed for chunk {i + 1}: {response}")
+        else:
+            answers = parse_batch_answers(response, len(questions))
+        if answers is None:
+            # Fall back to one call per question for this chunk
+            missing_answers.extend((question, i) for question in questions)
+            continue
+        for question, answer in zip(questions, answers):
+            all_qa_pairs[question] = answer
+
+    if missing_answers:
+        prompts = [f'Answer the following question:\n\n{question}\n\nusing the following text:\n\n{chunks[i]}\n\n' for question, i in missing_answers]
+        answers = generate_many(prompts)
+        for (question, _), answer in zip(missing_answers, answers):
+            all_qa_pairs[question] = answer.strip()
+
+    # Keep the order in which the questions were selected
+    all_qa_pairs = {question: all_qa_pairs[question] for question in selected_questions}
     
-    return all_qa_pairs, cached_questions
\ No newline at end of file
+    return all_qa_pairs, cached_questions
+
+def build_batch_answer_prompt(questions, chunk):
+    numbered_questions = "\n".join(f"{n}. {question}" for n, question in enumerate(questions, 1))
+    return f"""Answer each of the following questions using the text below, with the same language as the question.
+    Return only a JSON array of {len(questions)} strings, where the n-th string is the answer to question n.
+    Don't write anything else other than the JSON array.
+
+    Questions:
+    {numbered_questions}
+
+    Text:
+    {chunk}
+    """
+
+def parse_batch_answers(response_text, number_of_questions):
+    """Parse the JSON array returned for a batch of questions, None if it is unusable."""
+    text = response_text.strip()
+    # The model sometimes wraps the JSON in a markdown code block
+    match = re.search(r'\[.*\]', text, re.DOTALL)
+    if match is None:
+        return None
+    try:
+        answers = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(answers, list) or len(answers) != number_of_questions:
+        return None
+    return [str(answer).strip() for answer in answers]
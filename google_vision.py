@@ -1,14 +1,23 @@
-from google.cloud import vision
+# google.cloud.vision, pdfplumber and PyPDF2 are imported on first use to keep startup fast
 import io
 import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from dotenv import load_dotenv
-import pdfplumber
-import PyPDF2
+from metrics import STAGE_SECONDS
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', '4'))
+# Pages sent in one batch_annotate_images request, Vision accepts at most 16
+OCR_BATCH_SIZE = min(int(os.getenv('OCR_BATCH_SIZE', '4')), 16)
+
 
 def detect_text_image(path):
     """Detects text in the file and prints only the words."""
+    from google.cloud import vision
     client = vision.ImageAnnotatorClient()
 
     with io.open(path, 'rb') as image_file:
@@ -33,66 +42,135 @@ def detect_text_image(path):
             'https://cloud.google.com/apis/design/errors'.format(
                 response.error.message))
     
-def convert_pdf_to_images(file):
-    """Convert PDF pages to images."""
-    images = []
+def iter_pdf_images(file):
+    """Render PDF pages to images one at a time."""
+    import pdfplumber
     with pdfplumber.open(file) as pdf:
         for page in pdf.pages:
             im = page.to_image()
-            img = im.original
-            images.append(img)
-    return images
+            yield im.original
+            # Drop the parsed page objects, they are not needed anymore
+            page.flush_cache()
+
+def convert_pdf_to_images(file):
+    """Convert PDF pages to images."""
+    return list(iter_pdf_images(file))
+
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def detect_text_images(client, images):
+    """Run text detection on several images in one request, returns the text of each image."""
+    from google.cloud import vision
+    start = time.perf_counter()
+    requests = []
+    for image in images:
+        # Convert image to bytes
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format='PNG')
+        requests.append(vision.AnnotateImageRequest(
+            image=vision.Image(content=img_byte_arr.getvalue()),
+            features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)]))
+
+    response = client.batch_annotate_images(requests=requests)
+
+    page_texts = []
+    for page_response in response.responses:
+        if page_response.error.message:
+            raise Exception(
+                '{}\nFor more info on error messages, check: '
+                'https://cloud.google.com/apis/design/errors'.format(
+                    page_response.error.message))
+        texts = page_response.text_annotations
+        page_texts.append(texts[0].description if texts else None)  # Get all text from the page
+    # Pages of a batch share the request, each is counted with its share of the time
+    seconds_per_page = (time.perf_counter() - start) / len(images)
+    for _ in images:
+        STAGE_SECONDS.observe(seconds_per_page, stage='ocr_page')
+    return page_texts
 
 def process_pdf(file_path):
+    import PyPDF2
     with open(file_path, 'rb') as file:
         reader = PyPDF2.PdfReader(file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-    return text
+        pages = [page.extract_text() + "\n" for page in reader.pages]
+    return "".join(pages)
+
 
+def count_pdf_pages(file):
+    import PyPDF2
+    with open(file, 'rb') as f:
+        return len(PyPDF2.PdfReader(f).pages)
 
-def detect_text_pdf(pdf_path,watermark):
+def detect_text_pdf(pdf_path,watermark,progress=None,client=None):
     
-    """Detects text in a PDF file."""
+    """Detects text in a PDF file.
+
+    With a watermark the pages are OCR'd, and progress(pages_done, total_pages)
+    is called after each batch. An exception raised by progress stops the OCR.
+    client defaults to a new Vision ImageAnnotatorClient.
+    """
     if not watermark:
-        print('Extracting without watermark...')
+        logger.info('Extracting without watermark')
         text=process_pdf(pdf_path)
         return text
     else:
-        print('Extracting with watermark...')
-        client = vision.ImageAnnotatorClient()
-        
-        # Extract images from PDF
-        images = convert_pdf_to_images(pdf_path)
+        logger.info('Extracting with watermark')
+        if client is None:
+            from google.cloud import vision
+            client = vision.ImageAnnotatorClient()
         
+        # Pages are rendered lazily and OCR'd in batches by a pool of workers.
+        # Rendering waits while too many batches are in flight to bound memory.
+        results = {}
+        in_flight = {}
+        total_pages = count_pdf_pages(pdf_path) if progress else 0
+        pages_done = 0
+
+        def collect(future):
+            nonlocal pages_done
+            page_texts = future.result()
+            results[in_flight.pop(future)] = page_texts
+            pages_done += len(page_texts)
+            if progress:
+                progress(pages_done, total_pages)
+
+        with ThreadPoolExecutor(max_workers=OCR_WORKERS) as executor:
+            try:
+                for batch_number, images in enumerate(iter_batches(iter_pdf_images(pdf_path), OCR_BATCH_SIZE)):
+                    if len(in_flight) >= OCR_WORKERS * 2:
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            collect(future)
+                    in_flight[executor.submit(detect_text_images, client, images)] = batch_number
+
+                for future in as_completed(list(in_flight)):
+                    collect(future)
+            except BaseException:
+                # Don't start the batches still waiting for a worker
+                for future in in_flight:
+                    future.cancel()
+                raise
+
         all_text = []
-        
-        for i, image in enumerate(images):
-            # Convert image to bytes
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            content = img_byte_arr.getvalue()
-            
-            vision_image = vision.Image(content=content)
-            response = client.text_detection(image=vision_image)
-            texts = response.text_annotations
-            
-            if texts:
-                page_text = texts[0].description  # Get all text from the page
-                all_text.append(f"\n{page_text}\n")
-            
-            if response.error.message:
-                raise Exception(
-                    '{}\nFor more info on error messages, check: '
-                    'https://cloud.google.com/apis/design/errors'.format(
-                        response.error.message))
-        print("Done extracting...")
+        for batch_number in sorted(results):
+            for page_text in results[batch_number]:
+                if page_text:
+                    all_text.append(f"\n{page_text}\n")
+        logger.info("Done extracting")
         
         return "\n".join(all_text)
 
 
 def read_text_from_image(image_path):
+    from google.cloud import vision
     # Create a client
     client = vision.ImageAnnotatorClient()
 
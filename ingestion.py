@@ -0,0 +1,155 @@
+import os
+import itertools
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from metrics import current_trace, set_trace
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+INGESTION_WORKERS = int(os.getenv('INGESTION_WORKERS', '2'))
+# Documents of the same user processed at the same time, the others wait in the queue
+INGESTION_USER_LIMIT = int(os.getenv('INGESTION_USER_LIMIT', '1'))
+PARSE_PROCESSES = int(os.getenv('PARSE_PROCESSES', '2'))
+
+parse_executor = None
+parse_executor_lock = threading.Lock()
+
+def parse_start_method():
+    methods = multiprocessing.get_all_start_methods()
+    if threading.active_count() == 1 and 'fork' in methods:
+        return 'fork'
+    return 'forkserver' if 'forkserver' in methods else 'spawn'
+
+def start_parse_pool():
+    """Start the parsing processes if needed and return the pool.
+
+    Called from run_bot before the bot starts any thread, so the workers can
+    be forked safely, and they only copy the small startup memory thanks to
+    the lazy imports. A pool started again later, e.g. after a worker died,
+    is started with forkserver or spawn since forking a process with threads
+    can copy locks held by other threads and deadlock the children.
+    """
+    global parse_executor
+    with parse_executor_lock:
+        if parse_executor is None:
+            parse_executor = ProcessPoolExecutor(PARSE_PROCESSES, mp_context=multiprocessing.get_context(parse_start_method()))
+            # Forked workers are all started with the first task
+            parse_executor.submit(os.getpid).result()
+        return parse_executor
+
+def parse_in_process(func, *args):
+    """Run func(*args) in the parsing process pool and return its result."""
+    global parse_executor
+    executor = start_parse_pool()
+    try:
+        return executor.submit(func, *args).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory), start a new pool for the next jobs
+        with parse_executor_lock:
+            if parse_executor is executor:
+                parse_executor = None
+        raise
+
+class JobCancelled(Exception):
+    """Raised inside a job once it has been cancelled."""
+
+class IngestionJob:
+    job_ids = itertools.count(1)
+
+    def __init__(self, user_id, **params):
+        self.job_id = next(self.job_ids)
+        self.user_id = user_id
+        self.params = params
+        # The job continues the trace of the update that started it
+        self.trace_id = current_trace()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+class IngestionQueue:
+    """Queue of documents to ingest, processed by a few background threads.
+
+    Jobs of a user run in submission order, at most user_limit at a time, so
+    one user uploading many files doesn't hold every worker. run(job) does
+    the work and should call job.check_cancelled() between steps.
+    """
+
+    def __init__(self, run, num_workers=INGESTION_WORKERS, user_limit=INGESTION_USER_LIMIT):
+        self.run = run
+        self.num_workers = num_workers
+        self.user_limit = user_limit
+        self.pending = OrderedDict()
+        self.running = {}
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        with self.condition:
+            if self.threads:
+                return
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._worker, name=f"ingestion-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, user_id, **params):
+        self.start()
+        job = IngestionJob(user_id, **params)
+        with self.condition:
+            self.pending.setdefault(user_id, deque()).append(job)
+            self.condition.notify()
+        return job
+
+    def cancel_user(self, user_id):
+        """Cancel the queued and running jobs of a user."""
+        with self.condition:
+            jobs = list(self.pending.pop(user_id, ())) + list(self.running.get(user_id, ()))
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def _next_job(self):
+        for user_id, jobs in self.pending.items():
+            if len(self.running.get(user_id, ())) < self.user_limit:
+                job = jobs.popleft()
+                if not jobs:
+                    del self.pending[user_id]
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self._next_job()
+                self.running.setdefault(job.user_id, set()).add(job)
+
+            set_trace(job.trace_id)
+            try:
+                job.check_cancelled()
+                self.run(job)
+            except JobCancelled:
+                logger.info(f"Ingestion job {job.job_id} of user {job.user_id} cancelled")
+            except Exception as e:
+                logger.error(f"Error in ingestion job {job.job_id} of user {job.user_id}: {e}")
+            finally:
+                with self.condition:
+                    running = self.running[job.user_id]
+                    running.discard(job)
+                    if not running:
+                        del self.running[job.user_id]
+                    self.condition.notify_all()
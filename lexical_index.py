@@ -0,0 +1,100 @@
+import os
+import re
+import math
+import heapq
+import pickle
+from collections import Counter
+
+# Harakat, superscript alef and tatweel
+ARABIC_DIACRITICS = re.compile(r'[\u064B-\u0652\u0670\u0640]')
+# Alef with madda, hamza above, hamza below and wasla
+ALEF_VARIANTS = re.compile(r'[\u0622\u0623\u0625\u0671]')
+ARABIC_DIGITS = str.maketrans(''.join(chr(0x0660 + i) for i in range(10)), '0123456789')
+TOKEN = re.compile(r'\w+')
+# Definite article, stripped from longer words so "الخلية" matches "خلية"
+ARABIC_ARTICLE = '\u0627\u0644'
+
+def normalize_text(text):
+    text = text.lower().translate(ARABIC_DIGITS)
+    text = ARABIC_DIACRITICS.sub('', text)
+    text = ALEF_VARIANTS.sub('\u0627', text)
+    # Alef maksura and teh marbuta are often written as yeh and heh
+    return text.replace('\u0649', '\u064A').replace('\u0629', '\u0647')
+
+def tokenize(text):
+    tokens = TOKEN.findall(normalize_text(text))
+    return [token[2:] if token.startswith(ARABIC_ARTICLE) and len(token) > 4 else token for token in tokens]
+
+class LexicalIndex:
+    """BM25 inverted index over the sections of a document.
+
+    Sections are numbered in the order they are added, so the numbers match
+    the section positions in the vector store. Adding sections only updates
+    the postings of their terms, the statistics used for scoring are
+    computed at query time.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> {section: term frequency}
+        self.postings = {}
+        self.doc_lengths = []
+        self.total_length = 0
+        self.n_postings = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, texts):
+        for text in texts:
+            doc = len(self.doc_lengths)
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[doc] = tf
+            self.n_postings += len(counts)
+            length = sum(counts.values())
+            self.doc_lengths.append(length)
+            self.total_length += length
+
+    def search(self, query, k):
+        """(position, score) of the k best matching sections, best first."""
+        n = len(self.doc_lengths)
+        if n == 0:
+            return []
+        average_length = self.total_length / n or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, tf in docs.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_lengths[doc] / average_length)
+                scores[doc] = scores.get(doc, 0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def nbytes(self):
+        # Rough size of the Python dicts and ints holding the postings
+        return self.n_postings * 100 + len(self.postings) * 100 + len(self.doc_lengths) * 8
+
+    def save(self, path):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+        return index
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merge several rankings of the same items, best first."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0) + 1 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -1,116 +1,194 @@
+import time
+STARTUP_BEGIN = time.perf_counter()
+
 import ast
 import os
-import json
-import textwrap
-import time
+import threading
 import logging
 from dotenv import load_dotenv
 from telegram_handler import setup_bot, create_initial_options_keyboard, create_difficulty_keyboard, create_number_of_questions_keyboard, show_answers_keyboard, choose_document_type_keyboard
-from document_processor import process_document
-from gemini_handler import answer_question, Summarize, generate_qa_for_chunks
-from vector_db import add_document_to_db, get_relevant_chunks, clear_vector_db, get_chunks
+from document_processor import process_document, IMAGE_EXTENSIONS
+from gemini_handler import answer_question_stream, generate_qa_for_chunks
+from summarizer import summarize_document
+from vector_db import add_document_to_db, get_relevant_chunks, clear_vector_db, get_chunks, get_sections, vector_db, encode_query, get_search_key, list_documents, remove_document
+from answer_cache import AnswerCache
+from gemini_handler import get_model
+from disk_cache import DiskCache
 from telebot.apihelper import ApiTelegramException
+from outbox import Outbox, ProgressMessage, MAX_MESSAGE_LENGTH
+from ingestion import IngestionQueue, JobCancelled, parse_in_process, start_parse_pool
+from webhook_server import run_webhook
+from state_store import create_state_store
+from metrics import TraceIdFilter, timed, start_metrics_server
 
 # Load environment variables
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s')
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdFilter())
 logger = logging.getLogger(__name__)
 
 # Initialize Telegram Bot
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-bot = setup_bot(BOT_TOKEN)
-
-# Dictionary to store user-specific data
-user_data = {}
-
-# File to store user data
-USER_DATA_FILE = 'user_data.json'
-
-def load_user_data():
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, 'r') as f:
-            return json.load(f)
-    return {'allowed_users': [], 'admin_users': []}
-
-def save_user_data(data):
-    with open(USER_DATA_FILE, 'w') as f:
-        json.dump(data, f)
-
-# Load user data
-user_data_auth = load_user_data()
-ALLOWED_USERS = set(user_data_auth['allowed_users'])
-ADMIN_USERS = set(user_data_auth['admin_users'])
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '8'))
+BOT_QUEUE_SIZE = int(os.getenv('BOT_QUEUE_SIZE', '100'))
+# 'polling' or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+RESTART_MAX_DELAY = int(os.getenv('RESTART_MAX_DELAY', '30'))
+bot = setup_bot(BOT_TOKEN, num_workers=BOT_WORKERS, queue_size=BOT_QUEUE_SIZE)
+
+# Cache of extracted text by Telegram file_unique_id, so forwarded copies skip download and OCR
+EXTRACTION_CACHE_DIR = os.getenv('EXTRACTION_CACHE_DIR', 'extraction_cache')
+EXTRACTION_CACHE_MB = int(os.getenv('EXTRACTION_CACHE_MB', '512'))
+extraction_cache = DiskCache(EXTRACTION_CACHE_DIR, EXTRACTION_CACHE_MB * 1024 * 1024)
+
+# Every outgoing message goes through the outbox, which enforces Telegram's rate limits
+outbox = Outbox(
+    bot,
+    global_rate=float(os.getenv('OUTBOX_GLOBAL_RATE', '25')),
+    chat_rate=float(os.getenv('OUTBOX_CHAT_RATE', '1')),
+    chat_burst=int(os.getenv('OUTBOX_CHAT_BURST', '3')),
+    num_workers=int(os.getenv('OUTBOX_WORKERS', '4')),
+)
+
+# Streamed answers are shown by editing the message at most once per interval
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+
+# Answers to questions already asked about the same document
+answer_cache = AnswerCache()
+
+# Allowed and admin users, and each user's session
+state_store = create_state_store()
+
+def reply_to(message, text, **kwargs):
+    return outbox.send_text(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
 
 @bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
     user_id = message.from_user.id
-    if user_id in ALLOWED_USERS:
-        user_data[user_id] = {'current_document': None, 'questions': None, 'difficulty': None, 'watermark': False}
+    if state_store.has_role(user_id, 'allowed'):
+        state_store.reset_session(user_id)
         send_help_message(user_id)
-        bot.reply_to(message, "Welcome! Send me a PDF, Excel, CSV, or TXT file to process.\nارسل ملف pdf, excel, csv, txt")
+        reply_to(message, "Welcome! Send me a PDF, Excel, CSV, or TXT file to process.\nارسل ملف pdf, excel, csv, txt")
     else:
-        bot.reply_to(message, "Sorry, you are not authorized to use this bot.")
+        reply_to(message, "Sorry, you are not authorized to use this bot.")
     
     logger.info(f"User attempt: ID {user_id}")
 
 @bot.message_handler(commands=['myid'])
 def send_user_id(message):
     user_id = message.from_user.id
-    bot.reply_to(message, f"Your Telegram user ID is: {user_id}")
+    reply_to(message, f"Your Telegram user ID is: {user_id}")
 
 @bot.message_handler(commands=['adduser'])
 def add_user(message):
     admin_id = message.from_user.id
-    if admin_id not in ADMIN_USERS:
-        bot.reply_to(message, "Sorry, you don't have permission to add users.")
+    if not state_store.has_role(admin_id, 'admin'):
+        reply_to(message, "Sorry, you don't have permission to add users.")
         return
     
     try:
         new_user_id = int(message.text.split()[1])
-        ALLOWED_USERS.add(new_user_id)
-        user_data_auth['allowed_users'] = list(ALLOWED_USERS)
-        save_user_data(user_data_auth)
-        bot.reply_to(message, f"User {new_user_id} has been added to the allowed users list.")
+        state_store.add_user(new_user_id)
+        reply_to(message, f"User {new_user_id} has been added to the allowed users list.")
     except (IndexError, ValueError):
-        bot.reply_to(message, "Please provide a valid user ID. Usage: /adduser USER_ID")
+        reply_to(message, "Please provide a valid user ID. Usage: /adduser USER_ID")
 
 @bot.message_handler(commands=['removeuser'])
 def remove_user(message):
     admin_id = message.from_user.id
-    if admin_id not in ADMIN_USERS:
-        bot.reply_to(message, "Sorry, you don't have permission to remove users.")
+    if not state_store.has_role(admin_id, 'admin'):
+        reply_to(message, "Sorry, you don't have permission to remove users.")
         return
     
     try:
         user_id_to_remove = int(message.text.split()[1])
-        if user_id_to_remove in ALLOWED_USERS:
-            ALLOWED_USERS.remove(user_id_to_remove)
-            user_data_auth['allowed_users'] = list(ALLOWED_USERS)
-            save_user_data(user_data_auth)
-            bot.reply_to(message, f"User {user_id_to_remove} has been removed from the allowed users list.")
+        if state_store.remove_user(user_id_to_remove):
+            reply_to(message, f"User {user_id_to_remove} has been removed from the allowed users list.")
         else:
-            bot.reply_to(message, f"User {user_id_to_remove} is not in the allowed users list.")
+            reply_to(message, f"User {user_id_to_remove} is not in the allowed users list.")
     except (IndexError, ValueError):
-        bot.reply_to(message, "Please provide a valid user ID. Usage: /removeuser USER_ID")
+        reply_to(message, "Please provide a valid user ID. Usage: /removeuser USER_ID")
 
 @bot.message_handler(commands=['listusers'])
 def list_users(message):
     admin_id = message.from_user.id
-    if admin_id not in ADMIN_USERS:
-        bot.reply_to(message, "Sorry, you don't have permission to list users.")
+    if not state_store.has_role(admin_id, 'admin'):
+        reply_to(message, "Sorry, you don't have permission to list users.")
         return
     
-    user_list = "\n".join(f"- {user_id}" for user_id in ALLOWED_USERS)
-    bot.reply_to(message, f"Allowed Users:\n{user_list}")
+    user_list = "\n".join(f"- {user_id}" for user_id in state_store.list_users())
+    reply_to(message, f"Allowed Users:\n{user_list}")
+
+@bot.message_handler(commands=['cachestats'])
+def cache_stats(message):
+    admin_id = message.from_user.id
+    if not state_store.has_role(admin_id, 'admin'):
+        reply_to(message, "Sorry, you don't have permission to view cache statistics.")
+        return
+
+    stats = answer_cache.stats()
+    reply_to(message, f"Answer cache: {stats['entries']} entries, {stats['hits']} hits, {stats['semantic_hits']} similar-question hits, {stats['misses']} misses")
+
+@bot.message_handler(commands=['documents'])
+def show_documents(message):
+    user_id = message.chat.id
+    documents = list_documents(user_id)
+    if not documents:
+        reply_to(message, "You have no documents yet. Send me a file to add one.")
+        return
+
+    active = state_store.get_session(user_id).get('document_id')
+    lines = [f"{'*' if document_id == active else '-'} {document_id}. {name}" for document_id, name, _ in documents]
+    scope = f"document {active}" if active is not None else "all documents"
+    reply_to(message, "Your documents:\n" + "\n".join(lines) +
+             f"\n\nQuestions are answered from {scope}.\n/use ID to choose a document, /use all for all of them, /forget ID to remove one.")
+
+def parse_document_id(message, user_id):
+    """Document id given after a command, None if missing or not one of the user's documents."""
+    try:
+        document_id = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        return None
+    return document_id if any(document[0] == document_id for document in list_documents(user_id)) else None
+
+@bot.message_handler(commands=['use'])
+def use_document(message):
+    user_id = message.chat.id
+    if message.text.split()[1:2] == ['all']:
+        state_store.update_session(user_id, document_id=None, cached_questions=None)
+        reply_to(message, "Questions are now answered from all your documents.", reply_markup=create_initial_options_keyboard())
+        return
+
+    document_id = parse_document_id(message, user_id)
+    if document_id is None:
+        reply_to(message, "Please provide one of your document IDs, see /documents. Usage: /use ID or /use all")
+        return
+    state_store.update_session(user_id, document_id=document_id, cached_questions=None)
+    reply_to(message, f"Questions are now answered from document {document_id}.", reply_markup=create_initial_options_keyboard())
+
+@bot.message_handler(commands=['forget'])
+def forget_document(message):
+    user_id = message.chat.id
+    document_id = parse_document_id(message, user_id)
+    if document_id is None:
+        reply_to(message, "Please provide one of your document IDs, see /documents. Usage: /forget ID")
+        return
+    remove_document(user_id, document_id)
+    active = state_store.get_session(user_id).get('document_id')
+    # Cached questions point into the chunks of the documents searched, which just changed
+    if active is None or active == document_id:
+        state_store.update_session(user_id, document_id=None, cached_questions=None, qa_pairs=None)
+    reply_to(message, f"Document {document_id} has been removed.")
 
 @bot.message_handler(content_types=['document', 'photo'])
 def handle_document(message):
     user_id = message.from_user.id
-    
-    if user_id not in user_data:
-        user_data[user_id] = {'current_document': None, 'questions': None, 'difficulty': None, 'watermark': False}
-        print(user_data[user_id], user_id)
 
     try:
         file_info = bot.get_file(message.document.file_id)
@@ -119,67 +197,133 @@ def handle_document(message):
 
         if file_extension == '.pdf':
             markup = choose_document_type_keyboard()
-            bot.reply_to(message, "Does this PDF have a watermark?\nهل يحتوي هذا الملف على علامة مائية؟", reply_markup=markup)
+            reply_to(message, "Does this PDF have a watermark?\nهل يحتوي هذا الملف على علامة مائية؟", reply_markup=markup)
             
             bot.set_state(user_id, 'waiting_for_watermark_answer', message.chat.id)
             with bot.retrieve_data(user_id, message.chat.id) as data:
                 data['file_info'] = file_info
                 data['file_name'] = file_name
-            print('PDF processed.')
+            logger.debug('Asked whether the PDF has a watermark')
         else:
             process_file(message, file_info, file_name, file_extension, watermark=False)
 
     except Exception as e:
-        bot.reply_to(message, f"An error occurred: {str(e)}")
+        reply_to(message, f"An error occurred: {str(e)}")
 
 def process_file(message, file_info, file_name, file_extension, watermark):
     user_id = message.chat.id
-    print(user_id)
 
-    bot.send_message(message.chat.id, 'Please wait ....\nيرجى الانتظار ....')
-    
     try:
+        # The status message is edited as the document goes through each stage
+        status = outbox.send(message.chat.id, 'Please wait ....\nيرجى الانتظار ....').result()
+        ingestion_queue.submit(user_id, chat_id=message.chat.id, message_id=status.message_id, file_info=file_info,
+                               file_name=file_name, file_extension=file_extension, watermark=watermark)
+    except Exception as e:
+        outbox.send_text(message.chat.id, f"An error occurred while processing the file: {str(e)}")
+
+def ingest_document(job):
+    user_id = job.user_id
+    params = job.params
+    progress = ProgressMessage(outbox, params['chat_id'], params['message_id'], STREAM_EDIT_INTERVAL)
+
+    try:
+        progress.update('Extracting text ....\nجاري استخراج النص ....', force=True)
+        text = extract_text(params['file_info'], params['file_extension'], params['watermark'], user_id, job, progress)
+        job.check_cancelled()
+        if not text or not text.strip():
+            hint = " If it is a scanned PDF, send it again and choose the watermark option." if params['file_extension'] == '.pdf' and not params['watermark'] else ""
+            progress.update(f"No text could be found in this file.{hint}\nلم يتم العثور على نص في هذا الملف.", force=True)
+            return
+
+        progress.update('Indexing ....\nجاري الفهرسة ....', force=True)
+        # The document is added next to the user's other documents, an upload of one they already have returns its id
+        known_ids = {document[0] for document in list_documents(user_id)}
+        document_id = add_document_to_db(text, params['file_extension'][1:], user_id, params['file_name'])
+        if job.cancelled.is_set():
+            # The user started a new topic while the document was indexed, drop only what this job added
+            if document_id not in known_ids:
+                remove_document(user_id, document_id)
+            job.check_cancelled()
+        state_store.update_session(user_id, document_id=document_id, cached_questions=None)
+
+        progress.update(f'File processed successfully as document {document_id}, see /documents.\nتم معالجة الملف بنجاح.', force=True, reply_markup=create_initial_options_keyboard())
+    except JobCancelled:
+        progress.update('Cancelled.\nتم الإلغاء.', force=True)
+        raise
+    except Exception as e:
+        progress.update(f"An error occurred while processing the file: {str(e)}", force=True)
+
+ingestion_queue = IngestionQueue(ingest_document)
+
+def extract_text(file_info, file_extension, watermark, user_id, job, progress):
+    cache_key = f"{file_info.file_unique_id}_{int(watermark)}"
+    text = extraction_cache.get(cache_key)
+    if text is not None:
+        logger.debug(f'Extraction cache hit for file {file_info.file_unique_id}')
+        return text
+
+    with timed('download'):
         downloaded_file = bot.download_file(file_info.file_path)
-        temp_file_name = f"temp_{user_id}{file_extension}"
-        with open(temp_file_name, 'wb') as new_file:
-            new_file.write(downloaded_file)
-        
-        text = process_document(temp_file_name, watermark)
-        clear_vector_db(user_id)
-        add_document_to_db(text, file_extension[1:], user_id)
-        user_data[user_id]['current_document'] = file_name
+    job.check_cancelled()
+    temp_file_name = f"temp_{user_id}_{job.job_id}{file_extension}"
+    with open(temp_file_name, 'wb') as new_file:
+        new_file.write(downloaded_file)
 
+    def report_pages(pages_done, total_pages):
+        job.check_cancelled()
+        progress.update(f'OCR page {pages_done}/{total_pages}\nقراءة الصفحة {pages_done}/{total_pages}')
+
+    try:
+        with timed('extraction'):
+            if watermark or file_extension[1:] in IMAGE_EXTENSIONS:
+                # OCR waits on Google Vision, it runs in this thread and reports its progress
+                text = process_document(temp_file_name, watermark, report_pages)
+            else:
+                # Parsing is CPU bound, it runs in a separate process
+                text = parse_in_process(process_document, temp_file_name, watermark)
+    finally:
         os.remove(temp_file_name)
-        
-        bot.send_message(message.chat.id, 'File processed successfully.\nتم معالجة الملف بنجاح.', reply_markup=create_initial_options_keyboard())
-    except Exception as e:
-        bot.send_message(message.chat.id, f"An error occurred while processing the file: {str(e)}")
+
+    extraction_cache.put(cache_key, text)
+    return text
 
 @bot.message_handler(func=lambda message: True)
 def handle_question(message):
     user_id = message.chat.id
-    if user_id in user_data and user_data[user_id]['current_document']:
+    document_id = state_store.get_session(user_id).get('document_id')
+    # Answers depend on the documents searched, the active one or all of them
+    search_key = get_search_key(user_id, document_id)
+    if search_key is not None:
         question = message.text
         try:
-            relevant_chunks = get_relevant_chunks(question, user_id)
-            context = " ".join(relevant_chunks)
-            answer = answer_question(context, question)
-            bot.reply_to(message, answer, reply_markup=create_initial_options_keyboard())
+            query_vector = encode_query(question)
+            answer = answer_cache.get(search_key, question, query_vector)
+            if answer is None:
+                document_ids = [document_id] if document_id is not None else None
+                relevant_chunks = get_relevant_chunks(question, user_id, query_vector=query_vector, document_ids=document_ids)
+                context = " ".join(relevant_chunks)
+                pieces = answer_question_stream(context, question)
+                answer = stream_reply(message.chat.id, pieces, reply_to_message_id=message.message_id, reply_markup=create_initial_options_keyboard())
+                # An empty answer sends no message when served from the cache
+                if answer.strip():
+                    answer_cache.put(search_key, question, answer, query_vector)
+            else:
+                reply_to(message, answer, reply_markup=create_initial_options_keyboard())
         except Exception as e:
-            bot.reply_to(message, f"An error occurred while answering your question: {str(e)}")
+            reply_to(message, f"An error occurred while answering your question: {str(e)}")
     else:
-        bot.reply_to(message, "Please upload a document first to ask questions about it.")
+        reply_to(message, "Please upload a document first to ask questions about it.")
 
 @bot.callback_query_handler(func=lambda call: True)
 def callback_query(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
 
-    if user_id not in user_data:
-        user_data[user_id] = {'current_document': None, 'questions': None, 'difficulty': None, 'watermark': False}
+    session = state_store.get_session(user_id)
 
     if call.data in ['True', 'False']:
-        user_data[user_id]['watermark'] = call.data == 'True'
+        watermark = call.data == 'True'
+        state_store.update_session(user_id, watermark=watermark)
         bot.answer_callback_query(call.id, "Processing your file...")
         
         with bot.retrieve_data(user_id, chat_id) as data:
@@ -187,54 +331,51 @@ def callback_query(call):
             file_name = data['file_name']
 
         file_extension = os.path.splitext(file_name)[1].lower()
-        process_file(call.message, file_info, file_name, file_extension, user_data[user_id]['watermark'])
+        process_file(call.message, file_info, file_name, file_extension, watermark)
 
     elif call.data == "summarize":
-        bot.send_message(chat_id, 'Please wait ....\nيرجى الانتظار ....')
         try:
-            chunks = get_chunks(user_id)
-            summary = Summarize(chunks)
-            send_long_message(chat_id, summary)
-            bot.send_message(chat_id, "Summarization complete.\nتم انشاء ملخص", reply_markup=create_initial_options_keyboard())
+            # Parts of the document are summarized, then merged, and the final summary is streamed
+            stream_reply(chat_id, summarize_document(get_sections(user_id, session.get('document_id'))))
+            outbox.send_text(chat_id, "Summarization complete.\nتم انشاء ملخص", reply_markup=create_initial_options_keyboard())
         except Exception as e:
-            bot.send_message(chat_id, f"An error occurred during summarization: {str(e)}")
+            outbox.send_text(chat_id, f"An error occurred during summarization: {str(e)}")
 
     elif call.data == "generate_questions":
-        bot.send_message(chat_id, "Choose the difficulty level:", reply_markup=create_difficulty_keyboard())
+        outbox.send_text(chat_id, "Choose the difficulty level:", reply_markup=create_difficulty_keyboard())
 
     elif call.data in ['easy', 'medium', 'hard']:
-        user_data[user_id]['difficulty'] = call.data
-        bot.send_message(chat_id, 'How many questions would you like to generate?', reply_markup=create_number_of_questions_keyboard())
+        state_store.update_session(user_id, difficulty=call.data)
+        outbox.send_text(chat_id, 'How many questions would you like to generate?', reply_markup=create_number_of_questions_keyboard())
 
     elif call.data in ['5', '10', '15']:
-        chunks = get_chunks(user_id)
+        chunks = get_chunks(user_id, session.get('document_id'))
         n_questions = int(call.data)
-        difficulty = user_data[user_id]['difficulty']
-        bot.send_message(chat_id, 'Please wait ....\nيرجى الانتظار ....')
+        difficulty = session['difficulty']
+        outbox.send_text(chat_id, 'Please wait ....\nيرجى الانتظار ....')
         # Use the updated combined function
-        qa_pairs, cached_questions = generate_qa_for_chunks(chunks, difficulty, n_questions, user_data[user_id].get('cached_questions'))
+        qa_pairs, cached_questions = generate_qa_for_chunks(chunks, difficulty, n_questions, session.get('cached_questions'))
         
-        # Store the cached questions for future use
-        user_data[user_id]['cached_questions'] = cached_questions
-        
-        # Store the Q&A pairs
-        user_data[user_id]['qa_pairs'] = qa_pairs
+        # Store the cached questions for future use, and the Q&A pairs
+        state_store.update_session(user_id, cached_questions=cached_questions, qa_pairs=qa_pairs)
         
         # Create an ordered list of questions
         ordered_questions = '\n'.join([f"{i+1}. {q}" for i, q in enumerate(qa_pairs.keys())])
         
-        bot.send_message(chat_id, f'Here are your questions:\n{ordered_questions}', reply_markup=show_answers_keyboard())
+        outbox.send_text(chat_id, f'Here are your questions:\n{ordered_questions}', reply_markup=show_answers_keyboard())
 
     elif call.data == "show_answers":
-        bot.send_message(chat_id, 'Please wait ....\nيرجى الانتظار ....')
-        
-        qa_pairs = user_data[user_id]['qa_pairs']
+        qa_pairs = session.get('qa_pairs')
+        if not qa_pairs:
+            outbox.send_text(chat_id, 'Please generate questions first.', reply_markup=create_initial_options_keyboard())
+            return
+        outbox.send_text(chat_id, 'Please wait ....\nيرجى الانتظار ....')
+
+        # Packed into as few messages as possible
+        answers = "\n\n".join(f"Q{i}: {question}\nA: {answer}" for i, (question, answer) in enumerate(qa_pairs.items(), 1))
+        outbox.send_text(chat_id, answers)
         
-        for i, (question, answer) in enumerate(qa_pairs.items(), 1):
-            message = f"Q{i}: {question}\nA: {answer}\n"
-            bot.send_message(chat_id, message)
-        
-        bot.send_message(chat_id, f'done! تم الانتهاء', reply_markup=create_initial_options_keyboard())
+        outbox.send_text(chat_id, f'done! تم الانتهاء', reply_markup=create_initial_options_keyboard())
 
     elif call.data == "new_conversation":
         start_new_conversation(call)
@@ -244,46 +385,60 @@ def callback_query(call):
 
 def start_new_conversation(call):
     user_id = call.from_user.id
-    user_data[user_id] = {'current_document': None, 'questions': None, 'difficulty': None, 'watermark': False}
+    ingestion_queue.cancel_user(user_id)
+    state_store.reset_session(user_id)
     clear_vector_db(user_id)
 
     try:
         bot.answer_callback_query(call.id, "New conversation started.")
     except Exception as e:
-        print(f"Error answering callback query: {str(e)}")
+        logger.error(f"Error answering callback query: {str(e)}")
 
-    bot.send_message(call.message.chat.id, "Ready for a new document. Please upload a PDF, Excel, CSV, or TXT file.\nجاهز لملف جديد يرجى تحميل ملف pdf, excel, csv, txt")
+    outbox.send_text(call.message.chat.id, "Ready for a new document. Please upload a PDF, Excel, CSV, or TXT file.\nجاهز لملف جديد يرجى تحميل ملف pdf, excel, csv, txt")
 
-def send_long_message(chat_id, text, max_retries=3, retry_delay=5):
-    total_characters = sum(len(string) for string in text)
-    print('total characters:', total_characters)
-    if total_characters <= 1600:
-        messages = [text]
-        print('message length is smaller than 4096, text length: ', total_characters)
-    else:
-        messages = ' '.join(text)
-        messages = textwrap.wrap(messages, width=1600, break_long_words=False)
-        print('number of messages:', len(messages))
-
-    for message in messages:
-        for attempt in range(max_retries):
-            try:
-                bot.send_message(chat_id, message)
-                print(f"\nMessage sent: {message}")
-                break 
-            except ApiTelegramException as e:
-                print(f"Error sending message: {str(e)}")
-                if e.error_code == 429: 
-                    retry_after = e.result_json['parameters']['retry_after']
-                    time.sleep(retry_after)
-                    continue
-                elif attempt == max_retries - 1: 
-                    raise  
-            except Exception as e:
-                print(f"Error sending message: {str(e)}")
-                if attempt == max_retries - 1: 
-                    raise 
-                time.sleep(retry_delay)
+def split_point(text, limit):
+    """Index where text should be cut to fit in limit characters, preferring line and word ends."""
+    for separator in ('\n', ' '):
+        cut = text.rfind(separator, 0, limit)
+        if cut > limit // 2:
+            return cut
+    return limit
+
+def stream_reply(chat_id, pieces, reply_to_message_id=None, reply_markup=None):
+    """Show streamed text by editing a message as pieces arrive.
+
+    Edits are throttled to one per STREAM_EDIT_INTERVAL seconds and skipped
+    while the previous one is still queued in the outbox. Text beyond
+    Telegram's 4096 characters continues in a new message. The reply_markup
+    is attached to the last message. Returns the full text.
+    """
+    message = outbox.send(chat_id, 'Please wait ....\nيرجى الانتظار ....', reply_to_message_id=reply_to_message_id).result()
+    full_text = []
+    text = ''
+    shown_text = None
+    last_edit = None
+    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    for piece in pieces:
+        full_text.append(piece)
+        text += piece
+        while len(text) > MAX_MESSAGE_LENGTH:
+            cut = split_point(text, MAX_MESSAGE_LENGTH)
+            outbox.edit(chat_id, message.message_id, text[:cut])
+            message = outbox.send(chat_id, '....').result()
+            text = text[cut:].lstrip()
+            shown_text = None
+            last_edit = None
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        if text.strip() and text != shown_text and time.monotonic() >= next_edit and (last_edit is None or last_edit.done()):
+            last_edit = outbox.edit(chat_id, message.message_id, text)
+            shown_text = text
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    if not text.strip():
+        text = 'No answer was generated.\nلم يتم انشاء اجابة.'
+    outbox.edit(chat_id, message.message_id, text, reply_markup=reply_markup)
+    return ''.join(full_text)
 
 def send_help_message(chat_id):
     help_message = """
@@ -293,8 +448,12 @@ def send_help_message(chat_id):
     - show_answers - Show answers of the generated questions
     - new_conversation - Start a new conversation
     - help - Show this help message
+    - /documents - List your documents
+    - /use ID - Ask about one document, /use all - Ask about all of them
+    - /forget ID - Remove a document
 
     You can upload a PDF, Excel, CSV, or TXT file or an image.
+    Every file you upload is kept, so you can send a course one chapter at a time.
                      
     Use the buttons to interact with the bot.
     The bot can summarize the document, generate questions and answer them or interact with images or excel files.
@@ -316,12 +475,25 @@ def send_help_message(chat_id):
     إذا قمت بتحميل ملف PDF يحتوي على علامة مائية، تأكد من اختيار خيار العلامة المائية.
     /start: بدء محادثة جديدة.
     """
-    bot.send_message(chat_id, help_message)
+    outbox.send_text(chat_id, help_message)
 
-def run_bot():
+def warm_up():
+    """Load the embedding model and the Gemini client while the bot is already polling."""
+    start = time.perf_counter()
+    try:
+        vector_db.warm_up()
+        get_model()
+        logger.info(f"Models warmed up in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        logger.error(f"Warm up failed, models will be loaded on first use: {e}")
+
+def run_polling():
+    delay = 1
     while True:
+        started = time.monotonic()
         try:
             logger.info("Starting bot polling...")
+            bot.remove_webhook()
             bot.polling(none_stop=True, interval=1, timeout=20)
         except ApiTelegramException as e:
             logger.error(f"ApiTelegramException: {e}")
@@ -329,14 +501,25 @@ def run_bot():
                 retry_after = e.result_json.get('parameters', {}).get('retry_after', 30)
                 logger.info(f"Sleeping for {retry_after} seconds due to rate limiting")
                 time.sleep(retry_after)
-            else:
-                logger.info("Restarting bot polling in 10 seconds...")
-                time.sleep(10)
+                continue
         except Exception as e:
             logger.error(f"Unexpected error: {e}")
-            logger.info("Restarting bot polling in 10 seconds...")
-            time.sleep(10)
+        # Back off only while restarts keep failing quickly
+        if time.monotonic() - started > 60:
+            delay = 1
+        logger.info(f"Restarting bot polling in {delay} seconds...")
+        time.sleep(delay)
+        delay = min(delay * 2, RESTART_MAX_DELAY)
 
+def run_bot():
+    logger.info(f"Bot ready to poll {time.perf_counter() - STARTUP_BEGIN:.2f}s after start")
+    start_parse_pool()
+    start_metrics_server()
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+    if BOT_MODE == 'webhook':
+        run_webhook(bot, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET)
+    else:
+        run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from telebot.apihelper import ApiTelegramException
+from metrics import timed, current_trace, set_trace
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Pack text into as few messages as possible of at most limit characters.
+
+    Text is cut at paragraph breaks first, then at line breaks, sentence ends
+    and spaces, and only mid-word when a single word is too long.
+    """
+    separators = [r'\n\s*\n', r'\n', r'(?<=[.!?؟])\s+', r'\s+']
+
+    def joiner(level):
+        return ['\n\n', '\n', ' ', ' '][level]
+
+    def pack(part, level):
+        if len(part) <= limit:
+            return [part]
+        if level == len(separators):
+            return [part[i:i+limit] for i in range(0, len(part), limit)]
+        messages = []
+        current = ''
+        for sub_part in re.split(separators[level], part):
+            sub_part = sub_part.strip()
+            if not sub_part:
+                continue
+            candidate = f"{current}{joiner(level)}{sub_part}" if current else sub_part
+            if len(candidate) <= limit:
+                current = candidate
+                continue
+            if current:
+                messages.append(current)
+            if len(sub_part) <= limit:
+                current = sub_part
+            else:
+                # Too long on its own, split it further and keep packing after it
+                sub_messages = pack(sub_part, level + 1)
+                messages.extend(sub_messages[:-1])
+                current = sub_messages[-1]
+        if current:
+            messages.append(current)
+        return messages
+
+    text = text.strip()
+    if not text:
+        return []
+    return pack(text, 0)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class Outbox:
+    """Queue for every outgoing Telegram message and edit.
+
+    Calls are made by a few sender threads, in order for each chat, within a
+    global and a per-chat rate limit. A 429 response pauses the chat for the
+    time Telegram asks and retries the call, so handlers never sleep. Each
+    call returns a Future with the result of the Telegram method.
+    """
+
+    def __init__(self, bot, global_rate=25, chat_rate=1, chat_burst=3, num_workers=4, max_attempts=3):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.num_workers = num_workers
+        self.max_attempts = max_attempts
+        self.pending = OrderedDict()
+        self.chat_buckets = {}
+        self.not_before = {}
+        self.busy_chats = set()
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        with self.condition:
+            if self.threads:
+                return
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def call(self, method, chat_id, **kwargs):
+        """Queue bot.<method>(chat_id=chat_id, **kwargs)."""
+        self.start()
+        future = Future()
+        kwargs['chat_id'] = chat_id
+        with self.condition:
+            # [method, kwargs, future, attempts, trace id of the update that made the call]
+            self.pending.setdefault(chat_id, deque()).append([method, kwargs, future, 0, current_trace()])
+            self.condition.notify()
+        return future
+
+    def send(self, chat_id, text, **kwargs):
+        return self.call('send_message', chat_id, text=text, **kwargs)
+
+    def edit(self, chat_id, message_id, text, **kwargs):
+        return self.call('edit_message_text', chat_id, message_id=message_id, text=text, **kwargs)
+
+    def send_text(self, chat_id, text, reply_markup=None, **kwargs):
+        """Send text of any length in as few messages as possible, reply_markup goes on the last one."""
+        messages = split_message(text)
+        futures = []
+        for i, message in enumerate(messages):
+            markup = reply_markup if i == len(messages) - 1 else None
+            futures.append(self.send(chat_id, message, reply_markup=markup, **kwargs))
+        return futures
+
+    def _next_job(self, now):
+        """Pick the first chat allowed to send, returns (chat_id, None) or (None, seconds to wait)."""
+        wait = None
+        global_delay = self.global_bucket.delay(now)
+        for chat_id in self.pending:
+            if chat_id in self.busy_chats:
+                continue
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+            delay = max(self.not_before.get(chat_id, 0) - now, bucket.delay(now), global_delay)
+            if delay <= 0:
+                return chat_id, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    chat_id, wait = self._next_job(now)
+                    if chat_id is not None:
+                        break
+                    self.condition.wait(timeout=wait)
+                job = self.pending[chat_id].popleft()
+                # Rotate chats so a busy chat doesn't starve the others
+                self.pending.move_to_end(chat_id)
+                self.busy_chats.add(chat_id)
+                self.global_bucket.take(now)
+                self.chat_buckets[chat_id].take(now)
+
+            retry_after = None
+            method, kwargs, future, _, trace = job
+            set_trace(trace)
+            try:
+                with timed('telegram'):
+                    result = getattr(self.bot, method)(**kwargs)
+                future.set_result(result)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                    logger.warning(f"Rate limited in chat {chat_id}, retrying in {retry_after}s")
+                elif 'message is not modified' in str(e):
+                    future.set_result(None)
+                else:
+                    future.set_exception(e)
+            except Exception as e:
+                # Network errors are retried a few times
+                job[3] += 1
+                if job[3] >= self.max_attempts:
+                    future.set_exception(e)
+                else:
+                    retry_after = job[3]
+
+            with self.condition:
+                self.busy_chats.discard(chat_id)
+                if retry_after is not None:
+                    self.pending[chat_id].appendleft(job)
+                    self.not_before[chat_id] = time.monotonic() + retry_after
+                if not self.pending[chat_id]:
+                    del self.pending[chat_id]
+                    self.not_before.pop(chat_id, None)
+                    self._prune_buckets()
+                self.condition.notify_all()
+
+    def _prune_buckets(self, max_buckets=10000):
+        # Idle chats with a full bucket don't need to be remembered
+        if len(self.chat_buckets) <= max_buckets:
+            return
+        now = time.monotonic()
+        for chat_id in list(self.chat_buckets):
+            bucket = self.chat_buckets[chat_id]
+            if chat_id not in self.pending and bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+class ProgressMessage:
+    """A status message edited as a task progresses.
+
+    Updates are dropped while the previous edit is still queued or less than
+    interval seconds ago, unless force is set, so progress never floods the
+    outbox.
+    """
+
+    def __init__(self, outbox, chat_id, message_id, interval=1.5):
+        self.outbox = outbox
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self.last_edit = None
+        self.last_time = 0
+        self.last_text = None
+
+    def update(self, text, force=False, **kwargs):
+        now = time.monotonic()
+        if text == self.last_text:
+            return self.last_edit
+        if not force:
+            if self.last_edit is not None and not self.last_edit.done():
+                return None
+            if now - self.last_time < self.interval:
+                return None
+        self.last_text = text
+        self.last_time = now
+        self.last_edit = self.outbox.edit(self.chat_id, self.message_id, text, **kwargs)
+        return self.last_edit
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 'sqlite' keeps users and sessions across restarts and bot processes, 'memory' keeps them in this process only
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'state.db')
+# Sessions not used for this many seconds are dropped
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(7 * 24 * 60 * 60)))
+# Legacy file holding the allowed and admin users, imported once into an empty store
+USER_DATA_FILE = 'user_data.json'
+
+def new_session():
+    # document_id None means questions are about all the user's documents
+    return {'document_id': None, 'questions': None, 'difficulty': None, 'watermark': False}
+
+class MemoryStateStore:
+    """Users and sessions kept in this process, lost on restart."""
+
+    def __init__(self, session_ttl=SESSION_TTL):
+        self.session_ttl = session_ttl
+        self.users = {'allowed': set(), 'admin': set()}
+        # user_id -> (session, last used), least recently used first
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def has_users(self):
+        with self.lock:
+            return any(self.users.values())
+
+    def has_role(self, user_id, role):
+        with self.lock:
+            return user_id in self.users[role]
+
+    def add_user(self, user_id, role='allowed'):
+        with self.lock:
+            self.users[role].add(user_id)
+
+    def remove_user(self, user_id, role='allowed'):
+        """Returns False if the user didn't have the role."""
+        with self.lock:
+            if user_id not in self.users[role]:
+                return False
+            self.users[role].discard(user_id)
+            return True
+
+    def list_users(self, role='allowed'):
+        with self.lock:
+            return sorted(self.users[role])
+
+    def _expire_sessions(self, now):
+        while self.sessions:
+            user_id, (_, last_used) = next(iter(self.sessions.items()))
+            if last_used + self.session_ttl > now:
+                break
+            del self.sessions[user_id]
+
+    def get_session(self, user_id):
+        """Copy of the user's session, a new one if it doesn't exist or expired."""
+        now = time.time()
+        with self.lock:
+            self._expire_sessions(now)
+            entry = self.sessions.get(user_id)
+            return dict(entry[0]) if entry is not None else new_session()
+
+    def update_session(self, user_id, **fields):
+        now = time.time()
+        with self.lock:
+            self._expire_sessions(now)
+            entry = self.sessions.pop(user_id, None)
+            session = entry[0] if entry is not None else new_session()
+            session.update(fields)
+            self.sessions[user_id] = (session, now)
+
+    def reset_session(self, user_id):
+        with self.lock:
+            self.sessions.pop(user_id, None)
+            self.sessions[user_id] = (new_session(), time.time())
+
+class SQLiteStateStore:
+    """Users and sessions in a SQLite database in WAL mode.
+
+    Every change is a single transaction, so concurrent handler threads and
+    several bot processes sharing the database see consistent state. Sessions
+    are stored as JSON and expire session_ttl seconds after their last change.
+    """
+
+    def __init__(self, path=STATE_DB_PATH, session_ttl=SESSION_TTL, cleanup_interval=60 * 60):
+        self.session_ttl = session_ttl
+        self.cleanup_interval = cleanup_interval
+        self.next_cleanup = 0
+        self.lock = threading.Lock()
+        # Autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS users (user_id INTEGER, role TEXT, PRIMARY KEY (user_id, role))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, data TEXT, updated REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)')
+
+    def has_users(self):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM users LIMIT 1').fetchone() is not None
+
+    def has_role(self, user_id, role):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM users WHERE user_id = ? AND role = ?', (user_id, role)).fetchone()
+            return row is not None
+
+    def add_user(self, user_id, role='allowed'):
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO users VALUES (?, ?)', (user_id, role))
+
+    def remove_user(self, user_id, role='allowed'):
+        """Returns False if the user didn't have the role."""
+        with self.lock:
+            cursor = self.connection.execute('DELETE FROM users WHERE user_id = ? AND role = ?', (user_id, role))
+            return cursor.rowcount > 0
+
+    def list_users(self, role='allowed'):
+        with self.lock:
+            rows = self.connection.execute('SELECT user_id FROM users WHERE role = ? ORDER BY user_id', (role,))
+            return [user_id for user_id, in rows]
+
+    def _expire_sessions(self, now):
+        # Called with the lock held, expired sessions are ignored on read anyway
+        if now < self.next_cleanup:
+            return
+        self.next_cleanup = now + self.cleanup_interval
+        self.connection.execute('DELETE FROM sessions WHERE updated <= ?', (now - self.session_ttl,))
+
+    def _read_session(self, user_id, now):
+        row = self.connection.execute(
+            'SELECT data FROM sessions WHERE user_id = ? AND updated > ?', (user_id, now - self.session_ttl)).fetchone()
+        return json.loads(row[0]) if row is not None else new_session()
+
+    def _write_session(self, user_id, session, now):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (user_id, json.dumps(session), now))
+
+    def get_session(self, user_id):
+        """The user's session, a new one if it doesn't exist or expired."""
+        with self.lock:
+            return self._read_session(user_id, time.time())
+
+    def update_session(self, user_id, **fields):
+        now = time.time()
+        with self.lock:
+            # Read and write in one transaction so concurrent updates from other processes aren't lost
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                session = self._read_session(user_id, now)
+                session.update(fields)
+                self._write_session(user_id, session, now)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self._expire_sessions(now)
+
+    def reset_session(self, user_id):
+        now = time.time()
+        with self.lock:
+            self._write_session(user_id, new_session(), now)
+            self._expire_sessions(now)
+
+def migrate_user_data(store, path=USER_DATA_FILE):
+    """Import the users of a legacy user_data.json into an empty store."""
+    if not os.path.exists(path) or store.has_users():
+        return
+    with open(path, 'r') as f:
+        data = json.load(f)
+    for user_id in data.get('allowed_users', []):
+        store.add_user(int(user_id), 'allowed')
+    for user_id in data.get('admin_users', []):
+        store.add_user(int(user_id), 'admin')
+    logger.info(f"Imported {len(data.get('allowed_users', []))} allowed and {len(data.get('admin_users', []))} admin users from {path}")
+
+def create_state_store(backend=STATE_BACKEND):
+    if backend == 'sqlite':
+        store = SQLiteStateStore()
+    elif backend == 'memory':
+        store = MemoryStateStore()
+    else:
+        raise ValueError(f"Unsupported state backend: {backend}")
+    migrate_user_data(store)
+    return store
@@ -0,0 +1,118 @@
+import os
+import hashlib
+import logging
+from dotenv import load_dotenv
+from disk_cache import DiskCache
+from gemini_handler import generate_many, stream_text, build_summary_prompt
+from vector_db import estimate_tokens, split_long_sentence, VECTOR_DB_DIR, TOKENS_PER_WORD
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# gemini-pro accepts 30720 input tokens and writes at most 2048
+GEMINI_CONTEXT_TOKENS = int(os.getenv('GEMINI_CONTEXT_TOKENS', '30720'))
+GEMINI_OUTPUT_TOKENS = int(os.getenv('GEMINI_OUTPUT_TOKENS', '2048'))
+# Room left in each call for the instructions of the prompt
+PROMPT_TOKENS = 500
+# Length of the final summary
+SUMMARY_TARGET_TOKENS = int(os.getenv('SUMMARY_TARGET_TOKENS', '1500'))
+# Shortest summary asked for a part of the document
+SUMMARY_MIN_TOKENS = 200
+SUMMARY_CACHE_DIR = os.getenv('SUMMARY_CACHE_DIR', os.path.join(VECTOR_DB_DIR, 'summary_cache'))
+SUMMARY_CACHE_MB = int(os.getenv('SUMMARY_CACHE_MB', '256'))
+# Bump when the prompts change so old summaries are not reused
+SUMMARY_VERSION = 1
+
+summary_cache = DiskCache(SUMMARY_CACHE_DIR, SUMMARY_CACHE_MB * 1024 * 1024)
+
+def input_budget():
+    """Tokens of text that fit in one call next to the prompt and the answer."""
+    return GEMINI_CONTEXT_TOKENS - PROMPT_TOKENS - GEMINI_OUTPUT_TOKENS
+
+def pack_texts(texts, max_tokens):
+    """Merge consecutive texts into as few groups as possible of at most max_tokens each."""
+    groups = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        parts = split_long_sentence(text, max_tokens) if tokens > max_tokens else [text]
+        for part in parts:
+            tokens = estimate_tokens(part)
+            if current and current_tokens + tokens > max_tokens:
+                groups.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(part)
+            current_tokens += tokens
+    if current:
+        groups.append("\n\n".join(current))
+    return groups
+
+def build_merge_prompt(summaries, max_words):
+    return f"""
+        The following texts are summaries of consecutive parts of the same document.
+        Combine them into a single detailed summary of the whole document, in at most {max_words} words.
+
+        **Key points to consider:**
+        * **Keep the order of the document** and tell it like a story.
+        * **Don't repeat** what several parts say twice.
+        * **Avoid unsafe or explicit content:** Ensure the summary is appropriate for all audiences.
+        * **Maintain the same language:** Use the same language as the summaries under *Summaries to combine*\n\n
+        **Summaries to combine:**\n
+        {summaries}
+        """
+
+def build_prompt(text, level, max_tokens):
+    max_words = max(1, int(max_tokens / TOKENS_PER_WORD))
+    if level == 0:
+        return f"{build_summary_prompt(text)}\n        Write at most {max_words} words."
+    return build_merge_prompt(text, max_words)
+
+def cache_key(text, level, max_tokens):
+    key = f"{SUMMARY_VERSION}-{level}-{max_tokens}-{GEMINI_CONTEXT_TOKENS}\n{text}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def summarize_all(texts, level, max_tokens):
+    """Summarize texts in parallel, reusing cached summaries."""
+    keys = [cache_key(text, level, max_tokens) for text in texts]
+    summaries = [summary_cache.get(key) for key in keys]
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+    generated = generate_many([build_prompt(texts[i], level, max_tokens) for i in missing])
+    for i, summary in zip(missing, generated):
+        summaries[i] = summary
+        summary_cache.put(keys[i], summary)
+    return summaries
+
+def summarize_document(sections, target_tokens=SUMMARY_TARGET_TOKENS):
+    """Summarize a document of any length, yielding the final summary piece by piece.
+
+    The sections are packed into parts that fit the model's context window
+    and summarized in parallel (map), then the summaries are packed and
+    summarized again (reduce) until they fit in a single call, whose answer
+    is streamed. Every summary is cached by the hash of its input, so asking
+    again for the summary of the same document costs no Gemini call.
+    """
+    budget = input_budget()
+    target_tokens = min(target_tokens, GEMINI_OUTPUT_TOKENS)
+    texts = pack_texts(sections, budget)
+    level = 0
+    while len(texts) > 1:
+        # Ask for summaries short enough to fit in as few calls as possible at the next level
+        max_tokens = max(SUMMARY_MIN_TOKENS, min(GEMINI_OUTPUT_TOKENS, budget // len(texts)))
+        logger.info(f'Summarizing {len(texts)} parts at level {level}')
+        texts = pack_texts(summarize_all(texts, level, max_tokens), budget)
+        level += 1
+
+    if not texts:
+        return
+    key = cache_key(texts[0], level, target_tokens)
+    summary = summary_cache.get(key)
+    if summary is not None:
+        yield summary
+        return
+    pieces = []
+    for piece in stream_text(build_prompt(texts[0], level, target_tokens)):
+        pieces.append(piece)
+        yield piece
+    summary_cache.put(key, "".join(pieces))
@@ -1,8 +1,29 @@
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from dispatcher import UpdateDispatcher
 
-def setup_bot(token):
-    return telebot.TeleBot(token)
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot that hands every incoming update to an UpdateDispatcher
+    instead of running the handlers in the polling thread."""
+
+    def __init__(self, token, num_workers=8, queue_size=100, **kwargs):
+        # Handlers run synchronously inside the dispatcher workers
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = UpdateDispatcher(self._handle_update, num_workers, queue_size)
+
+    def process_new_updates(self, updates):
+        self.dispatcher.start()
+        for update in updates:
+            # Advance the offset now, the update is handled later by a worker
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self.dispatcher.submit(update)
+
+    def _handle_update(self, update):
+        super().process_new_updates([update])
+
+def setup_bot(token, num_workers=8, queue_size=100):
+    return DispatchingTeleBot(token, num_workers=num_workers, queue_size=queue_size)
 
 def create_initial_options_keyboard():
     keyboard = InlineKeyboardMarkup()
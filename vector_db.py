@@ -1,55 +1,449 @@
-
+import os
+import hashlib
+import sqlite3
+import threading
+import heapq
+from collections import OrderedDict
+from itertools import groupby
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import faiss
 import re
+from disk_cache import DiskCache
+from embedding_service import EmbeddingService
+from embedding_backends import MODEL_NAME, EMBEDDING_BACKEND, create_embedder
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from metrics import timed
+
+VECTOR_DB_DIR = os.getenv('VECTOR_DB_DIR', 'vector_store')
+VECTOR_DB_MEMORY_MB = int(os.getenv('VECTOR_DB_MEMORY_MB', '512'))
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', os.path.join(VECTOR_DB_DIR, 'embedding_cache'))
+EMBEDDING_CACHE_MB = int(os.getenv('EMBEDDING_CACHE_MB', '1024'))
+# Encode requests from all users are grouped into batches of up to this many texts
+EMBEDDING_MAX_BATCH = int(os.getenv('EMBEDDING_MAX_BATCH', '64'))
+EMBEDDING_BATCH_WAIT_MS = int(os.getenv('EMBEDDING_BATCH_WAIT_MS', '10'))
+
+# Bump whenever preprocess_text or chunk_document change so cached embeddings are not reused
+CHUNKER_VERSION = 3
+
+# Small chunks are embedded for retrieval, the model truncates its input at 128 tokens
+CHILD_CHUNK_TOKENS = int(os.getenv('CHILD_CHUNK_TOKENS', '100'))
+CHILD_CHUNK_OVERLAP_TOKENS = int(os.getenv('CHILD_CHUNK_OVERLAP_TOKENS', '20'))
+# Each small chunk belongs to a larger parent section that is sent to Gemini
+PARENT_CHUNK_SIZE = int(os.getenv('PARENT_CHUNK_SIZE', '4000'))
+# Consecutive parent sections are merged up to this size for summaries and question generation
+GENERATION_CHUNK_SIZE = int(os.getenv('GENERATION_CHUNK_SIZE', '22000'))
+# Index used for each user: 'flat' (exact search), 'ivf', 'hnsw', or 'auto' which
+# starts flat and switches to IVF once the user has VECTOR_ANN_THRESHOLD vectors
+VECTOR_INDEX_TYPE = os.getenv('VECTOR_INDEX_TYPE', 'auto')
+VECTOR_ANN_THRESHOLD = int(os.getenv('VECTOR_ANN_THRESHOLD', '10000'))
+# 'l2' distance, or 'ip' inner product on normalized vectors (cosine similarity)
+VECTOR_METRIC = os.getenv('VECTOR_METRIC', 'l2')
+IVF_NLIST = int(os.getenv('IVF_NLIST', '0'))  # 0 picks 4 * sqrt(number of vectors)
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', '16'))
+HNSW_M = int(os.getenv('HNSW_M', '32'))
+HNSW_EF_CONSTRUCTION = int(os.getenv('HNSW_EF_CONSTRUCTION', '64'))
+HNSW_EF_SEARCH = int(os.getenv('HNSW_EF_SEARCH', '64'))
+# How vectors are stored: 'float32', 'float16', 'sq8' (8-bit scalar quantizer) or 'pq' (product quantizer)
+VECTOR_STORAGE = os.getenv('VECTOR_STORAGE', 'float32')
+PQ_M = int(os.getenv('PQ_M', '48'))  # bytes per vector, must divide the embedding dimension
+# PQ needs about 39 training points for each of its 256 centroids, smaller corpora use sq8
+PQ_MIN_TRAIN = 256 * 39
+# Combine BM25 keyword search with vector search, exact terms and numbers are often missed by embeddings alone
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', 'true').lower() == 'true'
+# Reciprocal rank fusion constant, higher values flatten the weight of the top ranks
+RRF_K = 60
+
+# Rough number of model tokens per word. Arabic words carry attached articles, prepositions
+# and pronouns and split into more tokens, they are counted separately so Arabic chunks
+# stay within the embedding model's 128 tokens
+TOKENS_PER_WORD = 1.5
+ARABIC_TOKENS_PER_WORD = 3
+ARABIC_LETTER = re.compile(r'[\u0600-\u06FF]')
+
+faiss = None
+faiss_lock = threading.Lock()
+
+def load_faiss():
+    """Import faiss on first use, it is slow to import."""
+    global faiss
+    with faiss_lock:
+        if faiss is None:
+            import faiss as faiss_module
+            faiss = faiss_module
+    return faiss
+
+def choose_index_type(n_vectors, index_type=VECTOR_INDEX_TYPE):
+    if index_type == 'auto':
+        return 'flat' if n_vectors < VECTOR_ANN_THRESHOLD else 'ivf'
+    return index_type
+
+def choose_storage(n_vectors, storage=VECTOR_STORAGE):
+    if storage == 'pq' and n_vectors < PQ_MIN_TRAIN:
+        return 'sq8'
+    return storage
+
+def storage_codec(storage):
+    """Return the index_factory name of the vector encoding."""
+    codecs = {'float32': 'Flat', 'float16': 'SQfp16', 'sq8': 'SQ8', 'pq': f'PQ{PQ_M}'}
+    if storage not in codecs:
+        raise ValueError(f"Unsupported vector storage: {storage}")
+    return codecs[storage]
+
+def create_index(dimension, n_vectors, index_type=VECTOR_INDEX_TYPE, metric=VECTOR_METRIC, storage=VECTOR_STORAGE):
+    """Create an empty index suited for n_vectors vectors of the given dimension."""
+    faiss = load_faiss()
+    metric_type = faiss.METRIC_INNER_PRODUCT if metric == 'ip' else faiss.METRIC_L2
+    index_type = choose_index_type(n_vectors, index_type)
+    codec = storage_codec(choose_storage(n_vectors, storage))
+    if index_type == 'flat':
+        description = codec
+    elif index_type == 'ivf':
+        nlist = IVF_NLIST or int(4 * np.sqrt(n_vectors))
+        # Every list needs some training points
+        nlist = max(1, min(nlist, n_vectors // 39))
+        description = f'IVF{nlist},{codec}'
+    elif index_type == 'hnsw':
+        description = f'HNSW{HNSW_M},{codec}'
+    else:
+        raise ValueError(f"Unsupported index type: {index_type}")
+    index = faiss.index_factory(dimension, description, metric_type)
+    configure_index(index)
+    return index
+
+def configure_index(index):
+    """Apply the build and search parameters, they are not all kept when an index is saved."""
+    faiss = load_faiss()
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVF_NPROBE
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+
+def index_nbytes(index):
+    """Approximate memory used by the vectors of an index."""
+    faiss = load_faiss()
+    index = faiss.downcast_index(index)
+    extra = 0
+    if isinstance(index, faiss.IndexHNSW):
+        # Graph links on the base level, then the vectors themselves
+        extra = index.hnsw.nb_neighbors(0) * 4
+        index = faiss.downcast_index(index.storage)
+    try:
+        code_size = index.sa_code_size()
+    except RuntimeError:
+        # Not every index type reports its code size, assume float32 vectors
+        code_size = index.d * 4
+    return index.ntotal * (code_size + extra)
+
+def prepare_vectors(index_or_metric, vectors):
+    faiss = load_faiss()
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    if index_or_metric == 'ip' or getattr(index_or_metric, 'metric_type', None) == faiss.METRIC_INNER_PRODUCT:
+        faiss.normalize_L2(vectors)
+    return vectors
+
+def build_index(vectors, index_type=VECTOR_INDEX_TYPE, metric=VECTOR_METRIC):
+    index = create_index(vectors.shape[1], len(vectors), index_type, metric)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
 
 class UserVectorDB:
-    def __init__(self):
-        # Use a multilingual model to support both Arabic and English
-        self.model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-        self.user_indices = {}
-        self.user_texts = {}
-        self.user_document_types = {}
-
-    def add_texts(self, user_id, texts, document_type):
-        if user_id not in self.user_texts:
-            self.user_texts[user_id] = []
-            self.user_indices[user_id] = None
-
-        self.user_texts[user_id].extend(texts)
-        self.user_document_types[user_id] = document_type
-        embeddings = self.model.encode(texts)
-        
-        if self.user_indices[user_id] is None:
-            self.user_indices[user_id] = faiss.IndexFlatL2(embeddings.shape[1])
-        
-        self.user_indices[user_id].add(embeddings.astype('float32'))
-
-    def search(self, user_id, query, k=3):
-        if user_id not in self.user_indices:
+    """Vector store keeping every user's documents and their FAISS indices on disk.
+
+    A user can have many documents. Each one gets its own id, its own FAISS
+    index file and a BM25 index of its parent sections for keyword search,
+    and its chunk texts live in SQLite. Adding or removing a document never
+    touches the others. Indices are loaded lazily on first use and the most
+    recently used ones are kept in memory until they exceed the memory budget.
+    """
+
+    def __init__(self, storage_dir=VECTOR_DB_DIR, memory_budget=VECTOR_DB_MEMORY_MB * 1024 * 1024):
+        # The model is loaded on first use or by warm_up, not at import time
+        self._model = None
+        self.model_lock = threading.Lock()
+        self.embedding_service = EmbeddingService(self._encode_batch, EMBEDDING_MAX_BATCH, EMBEDDING_BATCH_WAIT_MS / 1000)
+        self.storage_dir = storage_dir
+        self.index_dir = os.path.join(storage_dir, 'indices')
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.memory_budget = memory_budget
+        self.hot_indices = OrderedDict()
+        self.hot_bytes = 0
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(os.path.join(storage_dir, 'chunks.db'), check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self._create_tables()
+            self.connection.commit()
+
+    def _create_tables(self):
+        self.connection.execute('CREATE TABLE IF NOT EXISTS documents (user_id INTEGER, document_id INTEGER, name TEXT, document_type TEXT, document_key TEXT, PRIMARY KEY (user_id, document_id))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS chunks (user_id INTEGER, document_id INTEGER, position INTEGER, text TEXT, PRIMARY KEY (user_id, document_id, position))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS children (user_id INTEGER, document_id INTEGER, position INTEGER, parent INTEGER, PRIMARY KEY (user_id, document_id, position))')
+
+    @property
+    def model(self):
+        with self.model_lock:
+            if self._model is None:
+                # Use a multilingual model to support both Arabic and English
+                self._model = create_embedder(MODEL_NAME, EMBEDDING_BACKEND)
+        return self._model
+
+    def _encode_batch(self, texts):
+        with timed('embedding'):
+            return self.model.encode(texts)
+
+    def warm_up(self):
+        """Load the embedding model and faiss ahead of the first request."""
+        load_faiss()
+        self.model
+
+    def _index_path(self, user_id, document_id):
+        return os.path.join(self.index_dir, f"{user_id}_{document_id}.faiss")
+
+    def _lexical_path(self, user_id, document_id):
+        return os.path.join(self.index_dir, f"{user_id}_{document_id}.bm25")
+
+    def _index_nbytes(self, index):
+        if isinstance(index, LexicalIndex):
+            return index.nbytes()
+        return index_nbytes(index)
+
+    def _remember_index(self, key, index):
+        """Keep an index in memory, key is (user_id, document_id, 'vectors' or 'lexical')."""
+        with self.lock:
+            if key in self.hot_indices:
+                self.hot_bytes -= self._index_nbytes(self.hot_indices.pop(key))
+            self.hot_indices[key] = index
+            self.hot_bytes += self._index_nbytes(index)
+            # Evict the least recently used indices, they can be reloaded from disk
+            while self.hot_bytes > self.memory_budget and len(self.hot_indices) > 1:
+                _, evicted = self.hot_indices.popitem(last=False)
+                self.hot_bytes -= self._index_nbytes(evicted)
+
+    def _forget_index(self, key):
+        with self.lock:
+            if key in self.hot_indices:
+                self.hot_bytes -= self._index_nbytes(self.hot_indices.pop(key))
+
+    def _get_index(self, user_id, document_id):
+        faiss = load_faiss()
+        key = (user_id, document_id, 'vectors')
+        with self.lock:
+            if key in self.hot_indices:
+                self.hot_indices.move_to_end(key)
+                return self.hot_indices[key]
+        path = self._index_path(user_id, document_id)
+        if not os.path.exists(path):
+            return None
+        index = faiss.read_index(path)
+        configure_index(index)
+        self._remember_index(key, index)
+        return index
+
+    def _get_lexical(self, user_id, document_id):
+        key = (user_id, document_id, 'lexical')
+        with self.lock:
+            if key in self.hot_indices:
+                self.hot_indices.move_to_end(key)
+                return self.hot_indices[key]
+        path = self._lexical_path(user_id, document_id)
+        if not os.path.exists(path):
+            return None
+        lexical = LexicalIndex.load(path)
+        self._remember_index(key, lexical)
+        return lexical
+
+    def _save_index(self, user_id, document_id, index):
+        faiss = load_faiss()
+        path = self._index_path(user_id, document_id)
+        temp_path = f"{path}.tmp"
+        faiss.write_index(index, temp_path)
+        os.replace(temp_path, path)
+
+    def encode(self, texts):
+        return self.embedding_service.encode(texts)
+
+    def add_texts(self, user_id, parents, children, child_parents, document_type, document_key=None, name=None):
+        embeddings = self.encode(children)
+        return self.add_embeddings(user_id, parents, child_parents, embeddings, document_type, document_key, name)
+
+    def add_embeddings(self, user_id, parents, child_parents, embeddings, document_type, document_key=None, name=None):
+        """Add a document from its parent sections and the embeddings of their child chunks, returns its id.
+
+        child_parents[i] is the position in parents of the section child chunk i belongs to.
+        document_key identifies the document content, users with the same document share it.
+        """
+        with self.lock:
+            document_id = self.connection.execute(
+                'SELECT COALESCE(MAX(document_id), 0) + 1 FROM documents WHERE user_id = ?', (user_id,)).fetchone()[0]
+            # Reserve the id, the rows are only visible once the index is saved
+            self.connection.execute('INSERT INTO documents (user_id, document_id, name, document_type, document_key) VALUES (?, ?, ?, ?, ?)',
+                                    (user_id, document_id, None, document_type, document_key))
+            self.connection.commit()
+
+        try:
+            # Each document has its own index, sized for it, and it never grows afterwards
+            index = build_index(prepare_vectors(VECTOR_METRIC, embeddings))
+            self._save_index(user_id, document_id, index)
+            self._remember_index((user_id, document_id, 'vectors'), index)
+
+            lexical = LexicalIndex()
+            lexical.add(parents)
+            lexical.save(self._lexical_path(user_id, document_id))
+            self._remember_index((user_id, document_id, 'lexical'), lexical)
+
+            with self.lock:
+                rows = [(user_id, document_id, i, text) for i, text in enumerate(parents)]
+                self.connection.executemany('INSERT INTO chunks (user_id, document_id, position, text) VALUES (?, ?, ?, ?)', rows)
+                rows = [(user_id, document_id, i, int(parent)) for i, parent in enumerate(child_parents)]
+                self.connection.executemany('INSERT INTO children (user_id, document_id, position, parent) VALUES (?, ?, ?, ?)', rows)
+                self.connection.execute('UPDATE documents SET name = ? WHERE user_id = ? AND document_id = ?',
+                                        (name or f"document {document_id}", user_id, document_id))
+                self.connection.commit()
+        except BaseException:
+            self.remove_document(user_id, document_id)
+            raise
+        return document_id
+
+    def _get_parents(self, user_id, children):
+        """Map (document_id, child position) pairs to (document_id, parent position) pairs, in order."""
+        parents = {}
+        for document_id, positions in groupby(sorted(children), key=lambda child: child[0]):
+            positions = [position for _, position in positions]
+            placeholders = ','.join('?' * len(positions))
+            with self.lock:
+                rows = self.connection.execute(
+                    f'SELECT position, parent FROM children WHERE user_id = ? AND document_id = ? AND position IN ({placeholders})',
+                    [user_id, document_id, *positions]).fetchall()
+            parents.update(((document_id, position), (document_id, parent)) for position, parent in rows)
+        return [parents[child] for child in children if child in parents]
+
+    def _get_texts(self, user_id, sections):
+        """Texts of (document_id, position) pairs, in order."""
+        texts = {}
+        for document_id, positions in groupby(sorted(sections), key=lambda section: section[0]):
+            positions = [position for _, position in positions]
+            placeholders = ','.join('?' * len(positions))
+            with self.lock:
+                rows = self.connection.execute(
+                    f'SELECT position, text FROM chunks WHERE user_id = ? AND document_id = ? AND position IN ({placeholders})',
+                    [user_id, document_id, *positions]).fetchall()
+            texts.update(((document_id, position), text) for position, text in rows)
+        return [texts[section] for section in sections if section in texts]
+
+    def search(self, user_id, query, k=3, query_vector=None, document_ids=None):
+        """Best matching parent sections in the given documents, or in all the user's documents."""
+        faiss = load_faiss()
+        if document_ids is None:
+            document_ids = [document[0] for document in self.list_documents(user_id)]
+        if not document_ids:
             return []
-        
-        query_vector = self.model.encode([query])
-        distances, indices = self.user_indices[user_id].search(query_vector.astype('float32'), k)
-        return [self.user_texts[user_id][i] for i in indices[0]]
+
+        if query_vector is None:
+            query_vector = self.encode([query])
+        query_vector = np.asarray(query_vector).reshape(1, -1)
+        # Several matching child chunks can share a parent, look at more of them
+        n_results = k * 4
+        hits = []
+        with timed('vector_search'):
+            for document_id in document_ids:
+                index = self._get_index(user_id, document_id)
+                if index is None or index.ntotal == 0:
+                    continue
+                distances, indices = index.search(prepare_vectors(index, query_vector), min(n_results, index.ntotal))
+                sign = 1 if index.metric_type == faiss.METRIC_INNER_PRODUCT else -1
+                # Approximate indices return -1 when they find fewer results than asked
+                hits.extend((sign * float(distance), document_id, int(i)) for distance, i in zip(distances[0], indices[0]) if i >= 0)
+            hits = heapq.nlargest(n_results, hits)
+        sections = list(dict.fromkeys(self._get_parents(user_id, [(document_id, i) for _, document_id, i in hits])))
+
+        if HYBRID_SEARCH:
+            keyword_hits = []
+            with timed('keyword_search'):
+                for document_id in document_ids:
+                    lexical = self._get_lexical(user_id, document_id)
+                    if lexical is None:
+                        continue
+                    keyword_hits.extend((score, document_id, position) for position, score in lexical.search(query, n_results))
+            keyword_sections = [(document_id, position) for _, document_id, position in heapq.nlargest(n_results, keyword_hits)]
+            sections = reciprocal_rank_fusion([sections, keyword_sections], RRF_K)
+        return self._get_texts(user_id, sections[:k])
+
+    def remove_document(self, user_id, document_id):
+        """Delete a document, its chunks and its indices. Returns False if it didn't exist."""
+        for kind in ('vectors', 'lexical'):
+            self._forget_index((user_id, document_id, kind))
+        for path in (self._index_path(user_id, document_id), self._lexical_path(user_id, document_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        with self.lock:
+            self.connection.execute('DELETE FROM chunks WHERE user_id = ? AND document_id = ?', (user_id, document_id))
+            self.connection.execute('DELETE FROM children WHERE user_id = ? AND document_id = ?', (user_id, document_id))
+            cursor = self.connection.execute('DELETE FROM documents WHERE user_id = ? AND document_id = ?', (user_id, document_id))
+            self.connection.commit()
+        return cursor.rowcount > 0
 
     def clear(self, user_id):
-        if user_id in self.user_indices:
-            del self.user_indices[user_id]
-        if user_id in self.user_texts:
-            del self.user_texts[user_id]
-        if user_id in self.user_document_types:
-            del self.user_document_types[user_id]
-
-    def get_full_text(self, user_id):
-        return " ".join(self.user_texts.get(user_id, []))
+        with self.lock:
+            document_ids = [row[0] for row in self.connection.execute('SELECT document_id FROM documents WHERE user_id = ?', (user_id,))]
+        for document_id in document_ids:
+            self.remove_document(user_id, document_id)
+
+    def list_documents(self, user_id):
+        """(document_id, name, document_type) of the user's documents, oldest first."""
+        with self.lock:
+            return self.connection.execute(
+                'SELECT document_id, name, document_type FROM documents WHERE user_id = ? AND name IS NOT NULL ORDER BY document_id',
+                (user_id,)).fetchall()
+
+    def find_document(self, user_id, document_key):
+        """Id of the user's document with this content, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT document_id FROM documents WHERE user_id = ? AND document_key = ? AND name IS NOT NULL',
+                (user_id, document_key)).fetchone()
+        return row[0] if row else None
+
+    def get_full_text(self, user_id, document_id=None):
+        return " ".join(self.get_sections(user_id, document_id))
+
+    def get_sections(self, user_id, document_id=None):
+        """Parent sections of a document, or of all the user's documents in upload order."""
+        with self.lock:
+            if document_id is None:
+                rows = self.connection.execute('SELECT text FROM chunks WHERE user_id = ? ORDER BY document_id, position', (user_id,)).fetchall()
+            else:
+                rows = self.connection.execute('SELECT text FROM chunks WHERE user_id = ? AND document_id = ? ORDER BY position', (user_id, document_id)).fetchall()
+        return [row[0] for row in rows]
     
-    def get_chunks(self, user_id):
-        return self.user_texts.get(user_id, [])
+    def get_chunks(self, user_id, document_id=None, chunk_size=GENERATION_CHUNK_SIZE):
+        """Return the document as consecutive parent sections merged up to chunk_size characters."""
+        chunks = []
+        current = []
+        current_size = 0
+        for section in self.get_sections(user_id, document_id):
+            if current and current_size + len(section) > chunk_size:
+                chunks.append(" ".join(current))
+                current = []
+                current_size = 0
+            current.append(section)
+            current_size += len(section) + 1
+        if current:
+            chunks.append(" ".join(current))
+        return chunks
 
-    def get_document_type(self, user_id):
-        return self.user_document_types.get(user_id)
+    def get_document_type(self, user_id, document_id):
+        with self.lock:
+            row = self.connection.execute('SELECT document_type FROM documents WHERE user_id = ? AND document_id = ?', (user_id, document_id)).fetchone()
+        return row[0] if row else None
+
+    def get_document_key(self, user_id, document_id):
+        with self.lock:
+            row = self.connection.execute('SELECT document_key FROM documents WHERE user_id = ? AND document_id = ?', (user_id, document_id)).fetchone()
+        return row[0] if row else None
 
 vector_db = UserVectorDB()
 
@@ -59,26 +453,198 @@ def preprocess_text(text):
     text = text.replace("\n", " ").strip()  # Replace newlines and strip extra spaces
     return text
 
-def chunk_text(text, chunk_size=22000):
-    return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+# Sentence ends in English and Arabic text
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?\u061F\u06D4])\s+|\n')
+
+def word_tokens(word):
+    return ARABIC_TOKENS_PER_WORD if ARABIC_LETTER.search(word) else TOKENS_PER_WORD
+
+def estimate_tokens(text):
+    return int(sum(word_tokens(word) for word in text.split())) + 1
+
+def split_paragraphs(text):
+    """Split text into paragraphs, each a list of preprocessed sentences."""
+    paragraphs = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        sentences = [preprocess_text(sentence) for sentence in SENTENCE_BOUNDARY.split(paragraph)]
+        sentences = [sentence for sentence in sentences if sentence]
+        if sentences:
+            paragraphs.append(sentences)
+    return paragraphs
 
-def add_document_to_db(text, document_type, user_id):
-    clean_text = preprocess_text(text)  # Preprocess the text for encoding issues
-    chunks = chunk_text(clean_text)
-    vector_db.add_texts(user_id, chunks, document_type)
+def split_long_sentence(sentence, max_tokens):
+    """Cut a sentence into pieces of at most max_tokens estimated tokens, at word boundaries."""
+    pieces = []
+    current = []
+    current_tokens = 1
+    for word in sentence.split():
+        tokens = word_tokens(word)
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append(" ".join(current))
+            current = []
+            current_tokens = 1
+        current.append(word)
+        current_tokens += tokens
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
 
-def get_relevant_chunks(query, user_id, k=3):
+def split_by_length(sentence, max_chars):
+    """Cut a sentence longer than max_chars at spaces, and inside words for text without spaces."""
+    if len(sentence) <= max_chars:
+        return [sentence]
+    pieces = []
+    current = []
+    current_size = 0
+    for word in sentence.split():
+        for start in range(0, len(word), max_chars):
+            part = word[start:start+max_chars]
+            if current and current_size + len(part) > max_chars:
+                pieces.append(" ".join(current))
+                current = []
+                current_size = 0
+            current.append(part)
+            current_size += len(part) + 1
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+def group_sentences(sentences, max_tokens, overlap_tokens):
+    """Group sentences into chunks of at most max_tokens, repeating up to
+    overlap_tokens of trailing sentences at the start of the next chunk."""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence in sentences:
+        for piece in split_long_sentence(sentence, max_tokens):
+            piece_tokens = estimate_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(" ".join(current))
+                overlap = []
+                overlap_size = 0
+                for previous in reversed(current):
+                    previous_tokens = estimate_tokens(previous)
+                    if overlap_size + previous_tokens > overlap_tokens or overlap_size + previous_tokens + piece_tokens > max_tokens:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_size += previous_tokens
+                current = overlap
+                current_tokens = overlap_size
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def chunk_document(text, child_tokens=CHILD_CHUNK_TOKENS, overlap_tokens=CHILD_CHUNK_OVERLAP_TOKENS, parent_size=PARENT_CHUNK_SIZE):
+    """Split text into parent sections and small overlapping child chunks.
+
+    Parents are built from whole sentences and end at a paragraph break when
+    possible. Children never cross a parent boundary. Returns the parents, the
+    children and, for every child, the position of its parent.
+    """
+    parent_sentences = []
+    current = []
+    current_size = 0
+    for paragraph in split_paragraphs(text):
+        # Text without punctuation or line breaks can be one huge sentence, cut it to the parent size
+        for sentence in (piece for sentence in paragraph for piece in split_by_length(sentence, parent_size)):
+            if current and current_size + len(sentence) > parent_size:
+                parent_sentences.append(current)
+                current = []
+                current_size = 0
+            current.append(sentence)
+            current_size += len(sentence) + 1
+        # Prefer to close a section at the end of a paragraph
+        if current_size >= parent_size * 0.75:
+            parent_sentences.append(current)
+            current = []
+            current_size = 0
+    if current:
+        parent_sentences.append(current)
+
+    parents = []
+    children = []
+    child_parents = []
+    for sentences in parent_sentences:
+        parent_children = group_sentences(sentences, child_tokens, overlap_tokens)
+        child_parents.extend([len(parents)] * len(parent_children))
+        children.extend(parent_children)
+        parents.append(" ".join(sentences))
+    return parents, children, child_parents
+
+embedding_cache = DiskCache(EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MB * 1024 * 1024)
+
+def document_cache_key(text):
+    chunker = f"{CHUNKER_VERSION}-{CHILD_CHUNK_TOKENS}-{CHILD_CHUNK_OVERLAP_TOKENS}-{PARENT_CHUNK_SIZE}"
+    content = f"{MODEL_NAME}-{EMBEDDING_BACKEND}\n{chunker}\n{text}".encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+def add_document_to_db(text, document_type, user_id, name=None):
+    """Add a document to the user's corpus and return its id.
+
+    Uploading the same content again returns the existing document.
+    """
+    key = document_cache_key(text)
+    document_id = vector_db.find_document(user_id, key)
+    if document_id is not None:
+        return document_id
+    # The same document is often uploaded by many users, reuse its embeddings
+    cached = embedding_cache.get(key)
+    if cached is not None:
+        parents, child_parents, embeddings = cached
+    else:
+        # Sentences are preprocessed one by one for encoding issues
+        parents, children, child_parents = chunk_document(text)
+        if not children:
+            raise ValueError("The document has no text")
+        embeddings = vector_db.encode(children)
+        # Keep cache entries small: int32 parent positions, and float16 vectors
+        # unless the index stores full precision anyway
+        cached_dtype = 'float32' if VECTOR_STORAGE == 'float32' else 'float16'
+        embedding_cache.put(key, (parents, np.asarray(child_parents, dtype='int32'), np.asarray(embeddings, dtype=cached_dtype)))
+    return vector_db.add_embeddings(user_id, parents, child_parents, embeddings, document_type, key, name)
+
+def encode_query(query):
     query = preprocess_text(query)  # Preprocess the query as well
-    return vector_db.search(user_id, query, k)
+    return vector_db.encode([query])[0]
+
+def get_relevant_chunks(query, user_id, k=3, query_vector=None, document_ids=None):
+    query = preprocess_text(query)  # Preprocess the query as well
+    return vector_db.search(user_id, query, k, query_vector, document_ids)
 
 def clear_vector_db(user_id):
     vector_db.clear(user_id)
 
-def get_full_text(user_id):
-    return vector_db.get_full_text(user_id)
+def remove_document(user_id, document_id):
+    return vector_db.remove_document(user_id, document_id)
+
+def list_documents(user_id):
+    return vector_db.list_documents(user_id)
+
+def get_full_text(user_id, document_id=None):
+    return vector_db.get_full_text(user_id, document_id)
+
+def get_chunks(user_id, document_id=None):
+    return vector_db.get_chunks(user_id, document_id)
+
+def get_sections(user_id, document_id=None):
+    return vector_db.get_sections(user_id, document_id)
+
+def get_document_type(user_id, document_id):
+    return vector_db.get_document_type(user_id, document_id)
+
+def get_document_key(user_id, document_id):
+    return vector_db.get_document_key(user_id, document_id)
 
-def get_chunks(user_id):
-    return vector_db.get_chunks(user_id)
+def get_search_key(user_id, document_id=None):
+    """Identify the content searched in a document, or in all the user's documents.
 
-def get_document_type(user_id):
-    return vector_db.get_document_type(user_id)
\ No newline at end of file
+    Returns None when there is nothing to search.
+    """
+    if document_id is not None:
+        return get_document_key(user_id, document_id)
+    keys = sorted(get_document_key(user_id, document[0]) or '' for document in list_documents(user_id))
+    if not keys:
+        return None
+    return keys[0] if len(keys) == 1 else hashlib.sha256("+".join(keys).encode('utf-8')).hexdigest()
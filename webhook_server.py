@@ -0,0 +1,96 @@
+import hmac
+import json
+import logging
+import sys
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from telebot.types import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+def create_webhook_server(bot, host, port, path, secret_token):
+    """HTTP server receiving Telegram updates on path.
+
+    Requests without the secret token are rejected. Valid updates are handed
+    to bot.process_new_updates, which queues them for the worker pool, and
+    acknowledged right away.
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def _respond(self, status):
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path != path:
+                self._respond(404)
+                return
+            received_token = self.headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(received_token.encode(), secret_token.encode()):
+                logger.warning(f"Rejected webhook request from {self.client_address[0]}: bad secret token")
+                self._respond(403)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                update = Update.de_json(self.rfile.read(length).decode('utf-8'))
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Invalid webhook update: {e}")
+                self._respond(400)
+                return
+            bot.process_new_updates([update])
+            self._respond(200)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return ThreadingHTTPServer((host, port), WebhookHandler)
+
+def run_webhook(bot, url, host, port, secret_token):
+    """Register url as the bot webhook and serve updates until interrupted.
+
+    Telegram only calls HTTPS urls, so the server is expected to run behind
+    a reverse proxy terminating TLS and forwarding to host:port.
+    """
+    if not secret_token:
+        raise ValueError("WEBHOOK_SECRET must be set in webhook mode")
+    path = urlparse(url).path or '/'
+    server = create_webhook_server(bot, host, port, path, secret_token)
+    bot.set_webhook(url=url, secret_token=secret_token)
+    logger.info(f"Webhook server listening on {host}:{port}{path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def send_fake_update(url, secret_token, text, chat_id=1, update_id=None):
+    """Post a text message update to a webhook server like Telegram would, returns the HTTP status."""
+    update_id = update_id if update_id is not None else int(time.time())
+    update = {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': text,
+        },
+    }
+    request = urllib.request.Request(
+        url, data=json.dumps(update).encode('utf-8'), method='POST',
+        headers={'Content-Type': 'application/json', SECRET_HEADER: secret_token})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+if __name__ == '__main__':
+    # Usage: python webhook_server.py URL SECRET TEXT [CHAT_ID]
+    url, secret_token, text = sys.argv[1:4]
+    chat_id = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    print(send_fake_update(url, secret_token, text, chat_id))